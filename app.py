@@ -1,108 +1,262 @@
 # app.py
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, send_from_directory, url_for, Response, stream_with_context, g
 from retriever import Retriever # Importa la clase Retriever
+from encoder import encoder_from_env
 from generator import TextGenerator # Importa la clase TextGenerator
+from batcher import QueryBatcher # Agrupa consultas de texto concurrentes en un solo lote
+from thumbnails import thumbnail_name, make_thumbnail # Miniaturas precalculadas por build_index
+from inverted_index import parse_filter, FilterSyntaxError # Filtros por palabras clave sobre las descripciones
+from metrics import metrics, RequestProfiler # Tiempos por etapa, /metrics y perfilado de peticiones
 import os
 import base64 # Para codificar imágenes a base64 para HTML
+import json
+import random
+import threading
+import time
 
 app = Flask(__name__)
+# Tamaño máximo de la petición (imágenes subidas incluidas); por encima Flask responde 413
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", "10")) * 1024 * 1024
+# Máximo de resultados que se pueden pedir por búsqueda (parámetro 'k' del formulario)
+MAX_RESULTS = int(os.getenv("MAX_RESULTS", "50"))
+# Cabecera Server-Timing con el tiempo de cada etapa de la petición (SERVER_TIMING=1)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+# Perfilado de peticiones concretas (se guarda en PROFILE_DIR):
+#   PROFILE_REQUESTS=1       -> se perfilan las peticiones con la cabecera 'X-Profile: 1' o '?profile=1'
+#   PROFILE_SAMPLE_RATE=0.01 -> además, una fracción de las peticiones al azar...
+#   PROFILE_SLOW_MS=500      -> ...de las que solo se guardan las que tardan al menos esto
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+_profile_lock = threading.Lock() # Un solo perfilado a la vez por proceso
 
 # Inicializa el retriever y el generador una única vez al inicio de la aplicación
 # Esto es importante para no recargar los modelos con cada solicitud.
 try:
-    retriever = Retriever()
+    # Backend de inferencia y torres de CLIP configurables por entorno (ver encoder_from_env)
+    retriever = Retriever(encoder=encoder_from_env())
     generator = TextGenerator()
+    # Las consultas de texto concurrentes se agrupan (hasta 32 o 5 ms) en una sola pasada de CLIP y de FAISS
+    batcher = QueryBatcher(retriever, max_batch_size=32, max_wait_ms=5)
 except Exception as e:
     print(f"Error al inicializar Retriever o TextGenerator: {e}")
-    print("Asegúrate de haber ejecutado 'indexer.py' para crear 'faiss_index.bin' y 'metadata.npy'.")
+    print("Asegúrate de haber ejecutado 'indexer.py' para crear 'faiss_index.bin' y 'metadata_store/'.")
     retriever = None # Establecer a None si la inicialización falla
     generator = None # Establecer a None si la inicialización falla
+    batcher = None
 
 
+def thumbnail_config():
+    # Configuración de miniaturas escrita por build_index en los metadatos (o valores por defecto)
+    info = getattr(retriever.metadata, "info", {}) if retriever else {}
+    return info.get("thumbnails", {"dir": "thumbnails", "width": 256, "format": "webp"})
+
+# La URL de cada miniatura lleva su fecha de modificación (?v=...): si se regenera, cambia la URL,
+# así que el navegador puede cachear cada URL durante 30 días sin volver a validarla
+THUMBNAIL_MAX_AGE = 30 * 24 * 3600
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    metrics.begin_request()
+    g.profiler = None
+    g.profile_explicit = PROFILE_REQUESTS and (request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1")
+    sampled = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    if (g.profile_explicit or sampled) and _profile_lock.acquire(blocking=False):
+        g.profiler = RequestProfiler()
+        g.profiler.start()
+
+@app.after_request
+def finish_request_timing(response):
+    # En /search/stream esto se ejecuta al empezar a enviar la respuesta: la generación en
+    # streaming queda fuera de estos tiempos (se mide con generate_first_token)
+    elapsed = time.perf_counter() - g.get("request_start", time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("rag_request_duration_seconds", elapsed, endpoint=endpoint)
+    metrics.inc("rag_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    if response.status_code >= 500:
+        metrics.inc("rag_errors_total", component="http")
+    timings = metrics.end_request()
+    if SERVER_TIMING:
+        stages = metrics.server_timing(timings)
+        response.headers["Server-Timing"] = f"total;dur={elapsed * 1000:.1f}" + (", " + stages if stages else "")
+    profiler = g.get("profiler")
+    if profiler is not None:
+        profiler.stop()
+        g.profiler = None
+        try:
+            if g.profile_explicit or elapsed * 1000 >= PROFILE_SLOW_MS:
+                name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{endpoint.strip('/') or 'index'}-{elapsed * 1000:.0f}ms"
+                path = profiler.save(PROFILE_DIR, name)
+                print(f"Perfil de la petición guardado en {path}")
+                response.headers["X-Profile-File"] = os.path.basename(path)
+        finally:
+            _profile_lock.release()
+    return response
+
+@app.teardown_request
+def stop_request_profiler(exc):
+    # Las métricas de la petición ya las registra after_request (también con la respuesta 500
+    # de una excepción no manejada); aquí solo se garantiza que el perfilador se detiene y se
+    # libera el cerrojo si algo falló antes de llegar a after_request
+    profiler = g.get("profiler")
+    if profiler is not None:
+        profiler.stop()
+        g.profiler = None
+        _profile_lock.release()
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Métricas del proceso en formato de texto de Prometheus. Con varios workers de gunicorn,
+    # cada respuesta corresponde al worker que atiende la petición.
+    if retriever and retriever.index is not None:
+        metrics.set("rag_index_vectors", retriever.index.ntotal)
+        metrics.set("rag_metadata_rows", len(retriever.metadata))
+    caches = {}
+    if retriever:
+        stats = retriever.cache_stats()
+        caches.update({name: stats[name] for name in ("embedding_cache", "result_cache", "filter_cache")})
+    if generator:
+        gen_stats = generator.stats()
+        caches["response_cache"] = gen_stats["response_cache"]
+        metrics.set("rag_generator_in_flight", gen_stats["in_flight"])
+        metrics.set("rag_generator_queued_or_running", gen_stats["queued_or_running"])
+        for name in ("coalesced", "timeouts", "rejected"):
+            metrics.set(f"rag_generator_{name}_total", gen_stats[name], kind="counter")
+    for cache_name, cache in caches.items():
+        metrics.set("rag_cache_hits_total", cache["hits"], kind="counter", cache=cache_name)
+        metrics.set("rag_cache_misses_total", cache["misses"], kind="counter", cache=cache_name)
+        metrics.set("rag_cache_entries", cache["size"], cache=cache_name)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({"error": f"La imagen es demasiado grande. El tamaño máximo es {limit_mb} MB."}), 413
+
 @app.route('/')
 def index():
     # Renderiza la plantilla HTML principal
     return render_template('index.html')
 
-@app.route('/search', methods=['POST'])
-def search():
-    # Verifica que el sistema esté inicializado correctamente
+@app.route('/cache/stats')
+def cache_stats():
+    # Estadísticas de aciertos/fallos de las cachés del Retriever y del generador
     if not retriever or not generator:
-        return jsonify({"error": "El sistema no está inicializado. Por favor, revisa los logs del servidor."}), 500
+        return jsonify({"error": "El sistema no está inicializado."}), 500
+    return jsonify({**retriever.cache_stats(), "generator": generator.stats()})
+
+@app.route('/thumbnails/<path:filename>')
+def thumbnail(filename):
+    # Sirve las miniaturas con ETag y Cache-Control (respuestas 304 si no han cambiado)
+    return send_from_directory(os.path.abspath(thumbnail_config()["dir"]), filename,
+                               max_age=THUMBNAIL_MAX_AGE, conditional=True, etag=True)
+
+def encode_image_b64(image_path):
+    with open(image_path, "rb") as img_file:
+        return base64.b64encode(img_file.read()).decode('utf-8')
+
+def thumbnail_url(res):
+    # URL de la miniatura de un resultado; si falta (p. ej. imagen añadida sin miniatura), se genera al vuelo
+    config = thumbnail_config()
+    name = thumbnail_name(res.get('image_id') or res['image_path'], config["format"])
+    path = os.path.join(config["dir"], name)
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        os.makedirs(config["dir"], exist_ok=True)
+        make_thumbnail(res['image_path'], path, width=config["width"], fmt=config["format"])
+        mtime = os.path.getmtime(path)
+    return url_for('thumbnail', filename=name, v=int(mtime))
 
-    query_type = request.form.get('query_type') # Obtiene el tipo de consulta (texto o imagen)
-    results = []
-    generated_response = ""
-    retrieved_descriptions = []
+def display_result(res, image_mode):
+    # Prepara un resultado para el navegador: URL de miniatura (por defecto) o imagen completa en base64
+    item = {
+        "description": res['description'],
+        "distance": f"{res['distance']:.4f}", # Formatear distancia
+    }
+    image_path = res['image_path']
+    if image_mode == 'base64':
+        item["image_b64"] = "" # Vacío si no hay imagen para mostrar
+    try:
+        if image_mode == 'base64':
+            item["image_b64"] = encode_image_b64(image_path) # Imagen codificada en base64
+        else:
+            item["thumbnail_url"] = thumbnail_url(res)
+    except FileNotFoundError:
+        print(f"Advertencia: Imagen no encontrada para mostrar: {image_path}")
+    except Exception as e:
+        print(f"Error al preparar imagen {image_path}: {e}")
+    return item
+
+def retrieve_for_request():
+    # Lee el formulario y ejecuta la recuperación. Devuelve (results, consulta para el
+    # generador, mensaje si no hay resultados, None) o (None, None, None, respuesta de error).
+    with metrics.span("parse_form"): # El primer acceso a request.form lee y parsea el cuerpo completo
+        query_type = request.form.get('query_type') # Obtiene el tipo de consulta (texto o imagen)
+        # Número de resultados (acotado) y filtro opcional, p. ej. 'perro playa -gato' o 'image:123.jpg'
+        try:
+            k = min(max(int(request.form.get('k', 5)), 1), MAX_RESULTS)
+        except ValueError:
+            return None, None, None, (jsonify({"error": "El parámetro k debe ser un número entero."}), 400)
+        filter_expr = request.form.get('filter', '').strip() or None
+        if filter_expr:
+            try:
+                parse_filter(filter_expr) # Se valida aquí para devolver el error de sintaxis al usuario
+            except FilterSyntaxError as e:
+                return None, None, None, (jsonify({"error": str(e)}), 400)
 
     if query_type == 'text':
         query_text = request.form.get('query_text')
-        if query_text:
-            results = retriever.retrieve_by_text(query_text)
-            # Extrae solo las descripciones para pasarlas al generador
-            retrieved_descriptions = [res['description'] for res in results]
-            if retrieved_descriptions:
-                generated_response = generator.generate_response(query_text, retrieved_descriptions)
-            else:
-                generated_response = "No se encontró información relevante para generar una respuesta."
-        else:
-            return jsonify({"error": "La consulta de texto no puede estar vacía."}), 400
+        if not query_text:
+            return None, None, None, (jsonify({"error": "La consulta de texto no puede estar vacía."}), 400)
+        # La codificación y la búsqueda se hacen en el hilo del batcher: aquí se ve el total
+        with metrics.span("retrieve"):
+            results = batcher.retrieve_by_text(query_text, k=k, filter_expr=filter_expr)
+        return results, query_text, "No se encontró información relevante para generar una respuesta.", None
 
-    elif query_type == 'image':
+    if query_type == 'image':
         # Verifica si se subió un archivo de imagen
         if 'query_image' not in request.files:
-            return jsonify({"error": "No se encontró parte de imagen en la solicitud."}), 400
+            return None, None, None, (jsonify({"error": "No se encontró parte de imagen en la solicitud."}), 400)
         file = request.files['query_image']
         if file.filename == '':
-            return jsonify({"error": "No se seleccionó ninguna imagen."}), 400
-        if file:
-            # Guarda la imagen subida temporalmente para que el retriever pueda leerla
-            temp_image_path = "temp_query_image.jpg"
-            file.save(temp_image_path)
+            return None, None, None, (jsonify({"error": "No se seleccionó ninguna imagen."}), 400)
+        # La imagen se procesa en memoria (sin archivo temporal compartido entre peticiones)
+        with metrics.span("read_upload"):
+            data = file.read()
+        with metrics.span("retrieve"):
+            results = retriever.retrieve_by_image(data, k=k, filter_expr=filter_expr)
+        # Para la generación, podemos usar una consulta genérica para imágenes
+        return results, "an image query", "No se encontró información relevante para generar una respuesta a partir de la imagen.", None
 
-            try:
-                # Realiza la recuperación por imagen
-                results = retriever.retrieve_by_image(temp_image_path)
-                retrieved_descriptions = [res['description'] for res in results]
-                # Para la generación, podemos usar una consulta genérica para imágenes
-                if retrieved_descriptions:
-                    generated_response = generator.generate_response("an image query", retrieved_descriptions)
-                else:
-                    generated_response = "No se encontró información relevante para generar una respuesta a partir de la imagen."
-            finally:
-                # Limpia: elimina la imagen temporal después de usarla
-                if os.path.exists(temp_image_path):
-                    os.remove(temp_image_path)
+    return None, None, None, (jsonify({"error": "Tipo de consulta no válido."}), 400)
+
+@app.route('/search', methods=['POST'])
+def search():
+    # Verifica que el sistema esté inicializado correctamente
+    if not retriever or not generator:
+        return jsonify({"error": "El sistema no está inicializado. Por favor, revisa los logs del servidor."}), 500
+
+    results, generation_query, no_results_message, error = retrieve_for_request()
+    if error:
+        return error
+
+    # Extrae solo las descripciones para pasarlas al generador
+    retrieved_descriptions = [res['description'] for res in results]
+    if retrieved_descriptions:
+        with metrics.span("generate"):
+            generated_response = generator.generate_response(generation_query, retrieved_descriptions,
+                                                             retrieved_ids=[res['id'] for res in results])
     else:
-        return jsonify({"error": "Tipo de consulta no válido."}), 400
+        generated_response = no_results_message
 
-    # Prepara los resultados para enviarlos al HTML:
-    # Convierte las imágenes a base64 para poder mostrarlas directamente en el navegador.
-    display_results = []
-    for res in results:
-        image_path = res['image_path']
-        try:
-            with open(image_path, "rb") as img_file:
-                encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
-                display_results.append({
-                    "description": res['description'],
-                    "image_b64": encoded_string, # Imagen codificada en base64
-                    "distance": f"{res['distance']:.4f}" # Formatear distancia
-                })
-        except FileNotFoundError:
-            print(f"Advertencia: Imagen no encontrada para mostrar: {image_path}")
-            display_results.append({
-                "description": res['description'],
-                "image_b64": "", # No hay imagen para mostrar
-                "distance": f"{res['distance']:.4f}"
-            })
-        except Exception as e:
-            print(f"Error al codificar imagen {image_path}: {e}")
-            display_results.append({
-                "description": res['description'],
-                "image_b64": "",
-                "distance": f"{res['distance']:.4f}"
-            })
+    # Prepara los resultados para enviarlos al HTML: por defecto se envía la URL de una
+    # miniatura; con image_mode=base64 se incrusta la imagen completa codificada en base64.
+    image_mode = request.form.get('image_mode', 'thumbnail')
+    with metrics.span("images"): # Miniaturas o lectura + base64 de las imágenes
+        display_results = [display_result(res, image_mode) for res in results]
 
     # Devuelve los resultados y la respuesta generada como JSON
     return jsonify({
@@ -110,5 +264,36 @@ def search():
         "generated_response": generated_response
     })
 
+@app.route('/search/stream', methods=['POST'])
+def search_stream():
+    # Igual que /search, pero en streaming (JSON por líneas, application/x-ndjson):
+    #   {"type": "results", "results": [...]}   en cuanto FAISS devuelve los resultados
+    #   {"type": "token", "text": "..."}        por cada fragmento que emite el modelo
+    #   {"type": "done"}                        al terminar
+    if not retriever or not generator:
+        return jsonify({"error": "El sistema no está inicializado. Por favor, revisa los logs del servidor."}), 500
+
+    results, generation_query, no_results_message, error = retrieve_for_request()
+    if error:
+        return error
+    image_mode = request.form.get('image_mode', 'thumbnail')
+    with metrics.span("images"):
+        display_results = [display_result(res, image_mode) for res in results]
+    retrieved_descriptions = [res['description'] for res in results]
+
+    def events():
+        yield json.dumps({"type": "results", "results": display_results}) + "\n"
+        if retrieved_descriptions:
+            for chunk in generator.generate_response_stream(generation_query, retrieved_descriptions,
+                                                            retrieved_ids=[res['id'] for res in results]):
+                yield json.dumps({"type": "token", "text": chunk}) + "\n"
+        else:
+            yield json.dumps({"type": "token", "text": no_results_message}) + "\n"
+        yield json.dumps({"type": "done"}) + "\n"
+
+    # X-Accel-Buffering evita que un proxy (nginx) acumule la respuesta antes de enviarla
+    return Response(stream_with_context(events()), mimetype='application/x-ndjson',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == '__main__':
     app.run(debug=True) # `debug=True` habilita el modo de depuración (recarga automática)
\ No newline at end of file
@@ -0,0 +1,72 @@
+# batcher.py
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+class QueryBatcher:
+    # Agrupa consultas de texto concurrentes (de distintas peticiones) en un solo lote:
+    # espera como máximo `max_wait_ms` o hasta juntar `max_batch_size` consultas, y entonces
+    # ejecuta una única pasada de CLIP y una única búsqueda FAISS con Retriever.retrieve_batch.
+    def __init__(self, retriever, max_batch_size=32, max_wait_ms=5):
+        self.retriever = retriever
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+
+    def _ensure_worker(self):
+        # El hilo se arranca en el primer uso (y de nuevo tras un fork, donde los hilos no se heredan)
+        with self._lock:
+            if self._worker is None or self._worker_pid != os.getpid() or not self._worker.is_alive():
+                self._queue = queue.Queue()
+                self._worker = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+                self._worker_pid = os.getpid()
+                self._worker.start()
+
+    def submit(self, query_text, k=5, filter_expr=None):
+        # Encola una consulta y devuelve un Future con su lista de resultados
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((query_text, k, filter_expr, future))
+        return future
+
+    def retrieve_by_text(self, query_text, k=5, timeout=None, filter_expr=None):
+        # Equivalente bloqueante a Retriever.retrieve_by_text, pero agrupado con otras consultas
+        return self.submit(query_text, k, filter_expr).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()] # Bloquea hasta que llegue la primera consulta
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Las consultas con el mismo filtro comparten búsqueda (el filtro se evalúa una vez)
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[2], []).append(item)
+            for filter_expr, group in groups.items():
+                queries = [query for query, _, _, _ in group]
+                # Se busca con el mayor k del grupo y se recorta para cada consulta
+                k = max(k for _, k, _, _ in group)
+                try:
+                    results = self.retriever.retrieve_batch(queries, k=k, filter_expr=filter_expr)
+                except Exception as e:
+                    for _, _, _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, query_k, _, future), query_results in zip(group, results):
+                    future.set_result(query_results[:query_k])
@@ -0,0 +1,43 @@
+# Herramientas de medición. Ejecutar desde la raíz del repositorio, p. ej.:
+#   python -m benchmarks.index_recall --index faiss_index.bin
+# Aquí están las utilidades comunes a todos los scripts (tiempos, percentiles, consultas, JSON).
+import json
+import time
+import numpy as np
+
+def time_calls(fn, items):
+    # Duración en ms de fn(item) para cada elemento
+    timings = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def percentiles(timings, qs=(50, 95)):
+    # Percentiles de una lista de tiempos (None si no hay mediciones)
+    if len(timings) == 0:
+        return tuple(None for _ in qs)
+    return tuple(float(np.percentile(timings, q)) for q in qs)
+
+def latency_summary(timings, qs=(50, 95, 99)):
+    # {"p50_ms": ..., "p95_ms": ..., "p99_ms": ..., "count": n}
+    return {**{f"p{q}_ms": value for q, value in zip(qs, percentiles(timings, qs))}, "count": len(timings)}
+
+def sample_index_queries(index, num_queries, seed=0):
+    # Vectores guardados en el índice elegidos al azar. En un índice por descripción son embeddings
+    # de texto reales, así que sirven como consultas de texto sin cargar CLIP. El índice debe
+    # admitir reconstruct (p. ej. flat).
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(index.ntotal, min(num_queries, index.ntotal), replace=False)
+    if len(rows) == 0:
+        return np.empty((0, index.d), dtype='float32')
+    return np.stack([index.reconstruct(int(r)) for r in rows]).astype('float32')
+
+def write_report(report, path=None, echo=True):
+    # Muestra el informe y, si se indica `path` (opción --json), lo guarda para comparar ejecuciones
+    if echo:
+        print(json.dumps(report, indent=2))
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,68 @@
+# benchmarks/encoder_parity.py
+# Compara un backend de MultimodalEncoder con la referencia PyTorch fp32:
+# desviación del coseno entre embeddings, cambio de recall@k y latencia por consulta.
+import argparse
+import numpy as np
+import faiss
+from encoder import MultimodalEncoder
+from metadata_store import load_metadata
+from benchmarks import time_calls, percentiles, write_report
+
+def cosine(a, b):
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return np.sum(a * b, axis=1)
+
+def top_k(corpus, queries, k):
+    index = faiss.IndexFlatL2(corpus.shape[1])
+    index.add(np.ascontiguousarray(corpus, dtype='float32'))
+    return index.search(np.ascontiguousarray(queries, dtype='float32'), k)[1]
+
+def query_latency_ms(encoder, queries):
+    return percentiles(time_calls(encoder.encode_text, queries))
+
+def parity(baseline, candidate, corpus_texts, query_texts, k=10):
+    base_corpus = baseline.encode_texts(corpus_texts)
+    cand_corpus = candidate.encode_texts(corpus_texts)
+    base_queries = baseline.encode_texts(query_texts)
+    cand_queries = candidate.encode_texts(query_texts)
+    cos = cosine(np.concatenate([base_corpus, base_queries]), np.concatenate([cand_corpus, cand_queries]))
+
+    # Recall@k del backend candidato (corpus y consultas propios) respecto al top-k de la referencia
+    reference = top_k(base_corpus, base_queries, k)
+    found = top_k(cand_corpus, cand_queries, k)
+    recall = np.mean([len(set(r) & set(f)) / k for r, f in zip(reference, found)])
+
+    base_p50, base_p95 = query_latency_ms(baseline, query_texts[:200])
+    cand_p50, cand_p95 = query_latency_ms(candidate, query_texts[:200])
+    return {
+        "backend": candidate.backend,
+        "cosine_mean": float(cos.mean()),
+        "cosine_min": float(cos.min()),
+        "cosine_drift_max": float(1 - cos.min()),
+        f"recall@{k}_vs_baseline": float(recall),
+        "baseline_query_p50_ms": base_p50, "baseline_query_p95_ms": base_p95,
+        "candidate_query_p50_ms": cand_p50, "candidate_query_p95_ms": cand_p95,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Paridad de un backend de inferencia frente a PyTorch fp32.")
+    parser.add_argument("--backend", default="onnx_int8", help="Backend a evaluar: torch_int8, onnx u onnx_int8")
+    parser.add_argument("--metadata", default="metadata_store", help="Metadatos de los que se toman las descripciones")
+    parser.add_argument("--corpus", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--json", help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    metadata = load_metadata(args.metadata)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(metadata), min(args.corpus + args.queries, len(metadata)), replace=False)
+    texts = [metadata[int(r)]["description"] for r in rows]
+    query_texts, corpus_texts = texts[:args.queries], texts[args.queries:]
+
+    baseline = MultimodalEncoder(backend="torch", num_threads=args.threads, load_vision=False)
+    candidate = MultimodalEncoder(backend=args.backend, num_threads=args.threads, load_vision=False)
+    report = parity(baseline, candidate, corpus_texts, query_texts, k=args.k)
+    write_report(report, args.json)
@@ -0,0 +1,181 @@
+# benchmarks/end_to_end.py
+# Benchmark de extremo a extremo que no necesita datos de Flickr ni red:
+#   - genera un corpus sintético de imágenes JPEG y descripciones (formato 'image|n|comment')
+#   - mide el rendimiento de build_index (descripciones/s)
+#   - mide la latencia p50/p95/p99 de Retriever.retrieve_by_text / retrieve_by_image
+#   - mide la latencia de /search con el cliente de pruebas de Flask y el generador falso
+#   - calcula recall@k texto -> imagen usando como consultas descripciones no indexadas
+# para varios tamaños de corpus, y guarda todo en JSON para comparar entre versiones.
+#
+# Por defecto usa encoder.FakeEncoder (bolsa de palabras con hashing): la recall mide entonces
+# la cadena índice + metadatos + deduplicación, no la calidad del modelo. Con --model se usa un
+# checkpoint de CLIP local (p. ej. uno pequeño descargado previamente).
+import argparse
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+
+# El generador falso y el encoder falso se eligen antes de importar app (lo inicializa al importarse)
+os.environ.setdefault("GENERATOR_BACKEND", "fake")
+os.environ.setdefault("ENCODER_BACKEND", "fake")
+
+from encoder import MultimodalEncoder, FakeEncoder
+from generator import TextGenerator, FakeBackend
+from indexer import build_index
+from retriever import Retriever
+from batcher import QueryBatcher
+from benchmarks import latency_summary, write_report
+
+COLORS = {"red": (200, 40, 40), "blue": (40, 60, 200), "green": (40, 160, 60), "yellow": (230, 210, 50),
+          "black": (20, 20, 20), "white": (235, 235, 235), "brown": (120, 80, 40), "orange": (240, 140, 30),
+          "pink": (240, 150, 190), "gray": (128, 128, 128)}
+SUBJECTS = ["dog", "cat", "man", "woman", "child", "horse", "bird", "car", "bicycle", "boat",
+            "girl", "boy", "truck", "train", "cow", "sheep"]
+ACTIONS = ["running", "sitting", "standing", "jumping", "walking", "sleeping", "playing", "waiting",
+           "riding", "looking"]
+PLACES = ["beach", "street", "park", "forest", "field", "river", "kitchen", "mountain", "city", "snow",
+          "garden", "market"]
+TEMPLATES = ["a {color} {subject} {action} on the {place}",
+             "the {subject} is {action} near a {place}",
+             "{color} {subject} {action} in the {place}",
+             "a photo of a {subject} in a {place}",
+             "someone sees a {color} {subject} {action}",
+             "{subject} {action} at the {place} today"]
+
+def synthetic_corpus(directory, num_images, captions_per_image=5, seed=0):
+    # Escribe `num_images` JPEG pequeños y un CSV con `captions_per_image - 1` descripciones por imagen.
+    # La última descripción de cada imagen no se indexa: se devuelve como consulta de evaluación.
+    rng = np.random.default_rng(seed)
+    image_folder = os.path.join(directory, "images")
+    os.makedirs(image_folder, exist_ok=True)
+    annotations_file = os.path.join(directory, "captions.csv")
+    held_out = []
+    color_names = list(COLORS)
+    with open(annotations_file, "w", encoding="utf-8") as f:
+        for i in range(num_images):
+            concept = {"color": color_names[rng.integers(len(color_names))],
+                       "subject": SUBJECTS[rng.integers(len(SUBJECTS))],
+                       "action": ACTIONS[rng.integers(len(ACTIONS))],
+                       "place": PLACES[rng.integers(len(PLACES))]}
+            image_id = f"{i:07d}.jpg"
+            img = Image.new("RGB", (96, 96), COLORS[concept["color"]])
+            draw = ImageDraw.Draw(img)
+            x, y = SUBJECTS.index(concept["subject"]) * 5, PLACES.index(concept["place"]) * 6
+            draw.ellipse((x, y, x + 30, y + 30), fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+            img.save(os.path.join(image_folder, image_id), format="JPEG", quality=85)
+
+            templates = rng.permutation(len(TEMPLATES))[:captions_per_image]
+            captions = [TEMPLATES[t].format(**concept) for t in templates]
+            for n, caption in enumerate(captions[:-1]):
+                f.write(f"{image_id}|{n}|{caption}\n")
+            held_out.append((image_id, captions[-1]))
+    return image_folder, annotations_file, held_out
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_size(encoder, directory, num_images, ks=(1, 5, 10), num_queries=500, num_search=200, index_type="flat", seed=0):
+    image_folder, annotations_file, held_out = synthetic_corpus(directory, num_images, seed=seed)
+    index_path = os.path.join(directory, "faiss_index.bin")
+    metadata_path = os.path.join(directory, "metadata_store")
+
+    start = time.perf_counter()
+    build_index(image_folder, annotations_file, encoder, index_path=index_path, metadata_path=metadata_path,
+                limit=0, cache_dir=None, index_type=index_type, thumbnail_dir=os.path.join(directory, "thumbnails"))
+    build_seconds = time.perf_counter() - start
+
+    # Sin recarga automática durante la medición. Dentro de cada medición las consultas son distintas,
+    # pero /search repite descripciones ya consultadas: las cachés se vacían antes (ver search_latency)
+    retriever = Retriever(index_path=index_path, metadata_path=metadata_path, encoder=encoder,
+                          reload_check_interval=3600)
+    num_captions = len(retriever.metadata.caption_image)
+    rng = np.random.default_rng(seed)
+    queries = [held_out[i] for i in rng.permutation(len(held_out))[:num_queries]]
+
+    # Recall texto -> imagen y latencia por texto con las descripciones no indexadas
+    max_k = max(ks)
+    hits = {k: 0 for k in ks}
+    text_ms = []
+    for image_id, caption in queries:
+        start = time.perf_counter()
+        results = retriever.retrieve_by_text(caption, k=max_k)
+        text_ms.append((time.perf_counter() - start) * 1000)
+        found = [res["image_id"] for res in results]
+        for k in ks:
+            hits[k] += image_id in found[:k]
+
+    # Latencia por imagen, con los bytes de imágenes del corpus como consultas subidas
+    image_ms = []
+    for image_id, _ in queries[:num_search]:
+        with open(os.path.join(image_folder, image_id), "rb") as f:
+            data = f.read()
+        start = time.perf_counter()
+        retriever.retrieve_by_image(data, k=5)
+        image_ms.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "images": num_images,
+        "captions": num_captions,
+        "index_type": index_type,
+        "build": {"seconds": build_seconds, "captions_per_sec": num_captions / max(build_seconds, 1e-9)},
+        "retrieve_by_text": latency_summary(text_ms),
+        "retrieve_by_image": latency_summary(image_ms),
+        "search_endpoint": search_latency(retriever, [caption for _, caption in queries[:num_search]]),
+        "recall": {f"recall@{k}": hits[k] / max(len(queries), 1) for k in ks},
+    }
+
+def search_latency(retriever, queries, k=5):
+    # /search completo (formulario, lote de consultas, búsqueda, miniaturas, generación con el
+    # backend falso y JSON) a través del cliente de pruebas de Flask, sin servidor ni red.
+    import app as web
+    web.retriever = retriever
+    web.batcher = QueryBatcher(retriever, max_batch_size=32, max_wait_ms=5)
+    web.generator = TextGenerator(backend=FakeBackend())
+    # Las consultas ya se buscaron con retrieve_by_text: sin vaciar las cachés, /search no
+    # codificaría el texto con CLIP (el coste dominante con --model)
+    retriever.embedding_cache.clear()
+    retriever.result_cache.clear()
+    client = web.app.test_client()
+    timings = []
+    errors = 0
+    for query in queries:
+        start = time.perf_counter()
+        response = client.post("/search", data={"query_type": "text", "query_text": query, "k": str(k)})
+        timings.append((time.perf_counter() - start) * 1000)
+        errors += response.status_code != 200
+    return {**latency_summary(timings), "errors": errors}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark de extremo a extremo y recall con un corpus sintético.")
+    parser.add_argument("--sizes", default="1000,5000,20000", help="Tamaños de corpus (número de imágenes)")
+    parser.add_argument("--model", help="Checkpoint local de CLIP; por defecto se usa FakeEncoder")
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--queries", type=int, default=500, help="Consultas de texto para recall y latencia")
+    parser.add_argument("--search-queries", type=int, default=200, help="Consultas por imagen y a /search")
+    parser.add_argument("--workdir", help="Carpeta donde generar los corpus (por defecto, una temporal)")
+    parser.add_argument("--json", default="benchmark_results.json", help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    encoder = MultimodalEncoder(model_name=args.model) if args.model else FakeEncoder()
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "encoder": encoder.model_name,
+        "sizes": [],
+    }
+    for size in (int(s) for s in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory(dir=args.workdir) as directory:
+            print(f"--- Corpus sintético de {size} imágenes ---")
+            report["sizes"].append(run_size(encoder, directory, size, num_queries=args.queries,
+                                            num_search=args.search_queries, index_type=args.index_type))
+    write_report(report, args.json)
@@ -0,0 +1,69 @@
+# benchmarks/filter_latency.py
+# Latencia de las búsquedas filtradas (ver inverted_index.py) según la selectividad del filtro:
+# fuerza bruta sobre el subconjunto, selector de IDs de FAISS y, como referencia, la búsqueda
+# global sin filtro. Los filtros son palabras del vocabulario elegidas por frecuencia.
+import argparse
+import time
+import numpy as np
+import faiss
+from index_factory import search_subset, search_params, subset_path
+from metadata_store import MetadataStore
+from benchmarks import time_calls, latency_summary, sample_index_queries, write_report
+
+SELECTIVITIES = (0.0001, 0.001, 0.01, 0.05, 0.2, 0.5)
+
+def pick_terms(store, selectivities):
+    # Para cada selectividad objetivo, la palabra cuya fracción de descripciones más se acerca
+    inverted = store.inverted_index
+    num_captions = len(store.caption_image)
+    tokens = list(inverted.vocab)
+    frequencies = np.array([inverted.document_frequency(token) for token in tokens]) / max(num_captions, 1)
+    terms = []
+    for target in selectivities:
+        token_id = int(np.argmin(np.abs(frequencies - target)))
+        # Entre comillas, para que palabras como 'or' o 'not' no se lean como operadores
+        terms.append((target, f'"{tokens[token_id]}"'))
+    return terms
+
+def time_search(fn, queries):
+    # p50/p95 de fn sobre cada consulta por separado (una por llamada, como en /search)
+    return latency_summary(time_calls(lambda q: fn(q[None, :]), queries), qs=(50, 95))
+
+def measure(index, store, k=5, num_queries=200, nprobe=None, ef_search=None, seed=0):
+    queries = sample_index_queries(index, num_queries, seed=seed)
+    params = search_params(index, nprobe=nprobe, ef_search=ef_search)
+
+    report = {"k": k, "vectors": index.ntotal,
+              "unfiltered": time_search(lambda q: index.search(q, k, params=params), queries), "filters": []}
+    for target, term in pick_terms(store, SELECTIVITIES):
+        start = time.perf_counter()
+        ids = store.rows_matching(term)
+        filter_ms = (time.perf_counter() - start) * 1000
+        entry = {"term": term, "target_selectivity": target, "matching_rows": int(len(ids)),
+                 "selectivity": len(ids) / max(index.ntotal, 1), "filter_eval_ms": filter_ms}
+        # threshold=inf pide la fuerza bruta; threshold=-1 fuerza el selector de IDs. "path" indica
+        # la estrategia que se ha medido de verdad (un IVF sin direct map no admite la fuerza bruta)
+        for name, threshold in (("brute_force", np.inf), ("id_selector", -1)):
+            try:
+                entry[name] = time_search(lambda q: search_subset(index, q, k, ids, brute_force_threshold=threshold,
+                                                                  nprobe=nprobe, ef_search=ef_search), queries)
+                entry[name]["path"] = subset_path(index, ids, threshold)
+            except RuntimeError as e:
+                entry[name] = {"error": str(e)}
+        report["filters"].append(entry)
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latencia de búsquedas filtradas según la selectividad del filtro.")
+    parser.add_argument("--index", default="faiss_index.bin")
+    parser.add_argument("--metadata", default="metadata_store")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--ef-search", type=int)
+    parser.add_argument("--json", help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    report = measure(faiss.read_index(args.index), MetadataStore(args.metadata), k=args.k,
+                     num_queries=args.queries, nprobe=args.nprobe, ef_search=args.ef_search)
+    write_report(report, args.json)
@@ -0,0 +1,60 @@
+# benchmarks/image_query.py
+# Latencia de consultas por imagen con fotos de varios megapíxeles:
+#   - 'temp_file': ruta anterior (guardar la subida en disco y volver a abrirla)
+#   - 'memory':    bytes en memoria con decodificación completa
+#   - 'memory_draft': bytes en memoria con decodificación JPEG reducida (modo borrador)
+import argparse
+import io
+import os
+import tempfile
+import numpy as np
+from PIL import Image
+from encoder import MultimodalEncoder
+from benchmarks import time_calls, latency_summary, write_report
+
+def synthetic_jpeg(width, height, seed=0):
+    # Imagen con gradientes y ruido (se comprime como una foto real, no como un color plano)
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    pixels = (x * [1.0, 0.3, 0.6] + y * [0.2, 0.9, 0.4]) / 1.5 + rng.normal(0, 20, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def measure(fn, repeats):
+    return latency_summary(time_calls(lambda _: fn(), range(repeats)), qs=(50, 95))
+
+def run(encoder, sizes, repeats=20):
+    report = []
+    draft_size = encoder.draft_size or 224
+    for width, height in sizes:
+        data = synthetic_jpeg(width, height)
+
+        def temp_file():
+            with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+                f.write(data)
+            try:
+                encoder.encode_image(f.name)
+            finally:
+                os.remove(f.name)
+
+        encoder.draft_size = None
+        full = measure(temp_file, repeats)
+        memory = measure(lambda: encoder.encode_image(data), repeats)
+        encoder.draft_size = draft_size
+        draft = measure(lambda: encoder.encode_image(data), repeats)
+        report.append({"megapixels": round(width * height / 1e6, 1), "upload_mb": round(len(data) / 2**20, 2),
+                       "temp_file": full, "memory": memory, "memory_draft": draft})
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latencia de codificación de imágenes de consulta grandes.")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--backend", default="torch")
+    parser.add_argument("--json", help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    encoder = MultimodalEncoder(backend=args.backend, load_text=False)
+    report = run(encoder, [(1600, 1200), (4000, 3000), (6000, 4000)], repeats=args.repeats)
+    write_report(report, args.json)
@@ -0,0 +1,62 @@
+# benchmarks/index_levels.py
+# Compara un índice por descripción (level='caption') con uno por imagen (level='image'):
+# número de vectores, memoria, latencia para obtener k imágenes distintas y duplicados en el top-k.
+import argparse
+import numpy as np
+import faiss
+from index_factory import index_memory_bytes
+from metadata_store import MetadataStore
+from benchmarks import time_calls, percentiles, sample_index_queries, write_report
+
+def distinct_top_k(index, store, query, k, overfetch=4):
+    # Lo mismo que hace Retriever con distinct_images=True: pedir más vecinos y quitar imágenes repetidas
+    k_fetch = max(k, min(k * overfetch, index.ntotal))
+    while True:
+        _, ids = index.search(query, k_fetch)
+        images = list(dict.fromkeys(store.image_of(i) for i in ids[0] if i >= 0))
+        if len(images) >= k or k_fetch >= index.ntotal:
+            return images[:k]
+        k_fetch = min(k_fetch * 2, index.ntotal)
+
+def compare(caption_index, caption_store, image_index, image_store, k=5, num_queries=300, seed=0):
+    queries = sample_index_queries(caption_index, num_queries, seed=seed)
+    # El índice por imagen guarda vectores normalizados: las consultas también se normalizan
+    normalized = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    raw_distinct = []
+    for q in queries:
+        _, ids = caption_index.search(q[None, :], k)
+        raw_distinct.append(len({caption_store.image_of(i) for i in ids[0] if i >= 0}))
+    caption_ms = time_calls(lambda q: distinct_top_k(caption_index, caption_store, q[None, :], k), queries)
+    image_ms = time_calls(lambda q: image_index.search(q[None, :], k), normalized)
+
+    caption_p50, caption_p95 = percentiles(caption_ms)
+    image_p50, image_p95 = percentiles(image_ms)
+    caption_mb = index_memory_bytes(caption_index) / 2**20
+    image_mb = index_memory_bytes(image_index) / 2**20
+    return {
+        "k": k,
+        "caption_level": {"vectors": caption_index.ntotal, "memory_mb": caption_mb,
+                          "distinct_latency_p50_ms": caption_p50, "distinct_latency_p95_ms": caption_p95,
+                          "avg_distinct_images_in_plain_top_k": float(np.mean(raw_distinct)) if raw_distinct else None},
+        "image_level": {"vectors": image_index.ntotal, "memory_mb": image_mb,
+                        "latency_p50_ms": image_p50, "latency_p95_ms": image_p95},
+        "memory_saved_pct": 100 * (1 - image_mb / caption_mb) if caption_mb else 0.0,
+        "latency_p50_saved_pct": 100 * (1 - image_p50 / caption_p50) if caption_p50 else 0.0,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Memoria y latencia del índice por imagen frente al índice por descripción.")
+    parser.add_argument("--caption-index", default="faiss_index.bin")
+    parser.add_argument("--caption-metadata", default="metadata_store")
+    parser.add_argument("--image-index", default="faiss_index_images.bin")
+    parser.add_argument("--image-metadata", default="metadata_store_images")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--json", help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    report = compare(faiss.read_index(args.caption_index), MetadataStore(args.caption_metadata),
+                     faiss.read_index(args.image_index), MetadataStore(args.image_metadata),
+                     k=args.k, num_queries=args.queries)
+    write_report(report, args.json)
@@ -0,0 +1,98 @@
+# benchmarks/index_recall.py
+# Compara los tipos de índice de index_factory contra el índice exacto (flat):
+# recall@k, memoria y latencia por consulta, usando los embeddings de un índice ya construido.
+import argparse
+import time
+import numpy as np
+import faiss
+from benchmarks import time_calls, percentiles, write_report
+from index_factory import INDEX_TYPES, create_index, train_index, search_params, index_memory_bytes
+
+def load_vectors(index_path):
+    # Recupera los embeddings almacenados en un índice existente (debe soportar reconstruct, p. ej. flat)
+    index = faiss.read_index(index_path)
+    return index.reconstruct_n(0, index.ntotal)
+
+def recall_at_k(approx_ids, exact_ids, k):
+    # None sin consultas (--queries 0, o un índice de menos de 10 vectores), como percentiles
+    if len(exact_ids) == 0 or k == 0:
+        return None
+    hits = sum(len(set(a[:k]) & set(e[:k])) for a, e in zip(approx_ids, exact_ids))
+    return hits / (k * len(exact_ids))
+
+def latency_ms(index, queries, k, params):
+    # Latencia de consultas individuales (una por llamada, como en /search)
+    if params is not None:
+        return percentiles(time_calls(lambda query: index.search(query[None, :], k, params=params), queries))
+    return percentiles(time_calls(lambda query: index.search(query[None, :], k), queries))
+
+def evaluate(vectors, index_types, k=10, num_queries=500, nprobes=(1, 8, 32), ef_searches=(16, 64, 256), train_size=100000, seed=0):
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    # Las consultas se separan de la base para no encontrarse a sí mismas
+    queries = np.ascontiguousarray(vectors[order[:num_queries]])
+    database = np.ascontiguousarray(vectors[order[num_queries:]])
+    dimension = database.shape[1]
+
+    exact = faiss.IndexFlatL2(dimension)
+    exact.add(database)
+    _, exact_ids = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        index = create_index(index_type, dimension, len(database))
+        start = time.perf_counter()
+        train_index(index, database, train_size=train_size, seed=seed)
+        index.add(database)
+        build_seconds = time.perf_counter() - start
+
+        if isinstance(index, faiss.IndexIVF):
+            settings = [("nprobe", n) for n in nprobes if n <= index.nlist]
+        elif isinstance(index, faiss.IndexHNSW):
+            settings = [("efSearch", e) for e in ef_searches]
+        else:
+            settings = [(None, None)]
+
+        for name, value in settings:
+            params = search_params(index, nprobe=value if name == "nprobe" else None,
+                                   ef_search=value if name == "efSearch" else None)
+            if params is not None:
+                _, ids = index.search(queries, k, params=params)
+            else:
+                _, ids = index.search(queries, k)
+            p50, p95 = latency_ms(index, queries, k, params)
+            rows.append({
+                "index_type": index_type,
+                "param": f"{name}={value}" if name else "-",
+                f"recall@{k}": recall_at_k(ids, exact_ids, k),
+                "memory_mb": index_memory_bytes(index) / 2**20,
+                "latency_p50_ms": p50,
+                "latency_p95_ms": p95,
+                "build_s": build_seconds,
+            })
+    return rows
+
+def cell(value, width, decimals):
+    # Los valores None (sin consultas) se muestran como '-'
+    return f"{'-':>{width}}" if value is None else f"{value:>{width}.{decimals}f}"
+
+def print_table(rows, k):
+    print(f"{'tipo':<10} {'parámetro':<14} {'recall@' + str(k):>10} {'memoria MB':>11} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8}")
+    for r in rows:
+        print(f"{r['index_type']:<10} {r['param']:<14} {cell(r[f'recall@{k}'], 10, 4)} {r['memory_mb']:>11.2f} "
+              f"{cell(r['latency_p50_ms'], 8, 3)} {cell(r['latency_p95_ms'], 8, 3)} {r['build_s']:>8.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recall@k, memoria y latencia de cada tipo de índice frente a búsqueda exacta.")
+    parser.add_argument("--index", default="faiss_index.bin", help="Índice flat existente del que se extraen los embeddings")
+    parser.add_argument("--types", default=",".join(INDEX_TYPES), help="Tipos de índice separados por comas")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--json", help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.index)
+    print(f"{len(vectors)} embeddings cargados desde {args.index}")
+    rows = evaluate(vectors, args.types.split(","), k=args.k, num_queries=min(args.queries, len(vectors) // 10))
+    print_table(rows, args.k)
+    write_report(rows, args.json, echo=False) # La tabla ya se ha mostrado
@@ -0,0 +1,31 @@
+# benchmarks/worker_rss.py
+# Mide la memoria de un servidor de serve.py: RSS y PSS del maestro y de cada worker.
+# RSS cuenta las páginas compartidas en cada proceso; PSS las reparte, así que la suma de PSS
+# es la memoria real que ocupa el conjunto.
+import argparse
+from serve import process_memory
+from benchmarks import write_report
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            return [int(p) for p in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="RSS/PSS por worker de un servidor gunicorn.")
+    parser.add_argument("master_pid", type=int, help="PID del proceso maestro de serve.py")
+    parser.add_argument("--json", help="Guardar los resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    report = {"master": {"pid": args.master_pid, **process_memory(args.master_pid)}, "workers": []}
+    for pid in children(args.master_pid):
+        report["workers"].append({"pid": pid, **process_memory(pid)})
+    workers = report["workers"]
+    if workers:
+        report["avg_worker_rss_mb"] = sum(w.get("rss", 0) for w in workers) / len(workers)
+        report["avg_worker_private_mb"] = sum(w.get("private_clean", 0) + w.get("private_dirty", 0) for w in workers) / len(workers)
+        report["total_pss_mb"] = report["master"].get("pss", 0) + sum(w.get("pss", 0) for w in workers)
+
+    write_report(report, args.json)
@@ -0,0 +1,115 @@
+# embedding_cache.py
+import os
+import json
+import hashlib
+import numpy as np
+
+class EmbeddingCache:
+    # Almacén de embeddings en disco direccionado por contenido.
+    # La clave de cada vector es el hash SHA-1 de (encoder.cache_id: modelo + backend, tipo, texto o bytes de la imagen),
+    # de modo que una descripción o imagen ya codificada nunca se vuelve a codificar.
+    #
+    # Formato del directorio:
+    #   meta.json    -> dimensión de los vectores
+    #   vectors.f32  -> vectores float32 concatenados (solo se añade al final)
+    #   keys.txt     -> una clave hexadecimal por línea; la línea i corresponde al vector i
+    def __init__(self, cache_dir, dimension=None):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.meta_path = os.path.join(cache_dir, "meta.json")
+        self.vectors_path = os.path.join(cache_dir, "vectors.f32")
+        self.keys_path = os.path.join(cache_dir, "keys.txt")
+
+        self.dimension = dimension
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                stored_dimension = json.load(f)["dimension"]
+            if dimension is not None and dimension != stored_dimension:
+                raise ValueError(f"La caché en '{cache_dir}' tiene dimensión {stored_dimension}, no {dimension}.")
+            self.dimension = stored_dimension
+
+        self.rows = {} # clave -> fila en vectors.f32
+        if self.dimension is not None:
+            self._load()
+        self._vectors = None # memmap de lectura, se reabre cuando crece el archivo
+        self._vectors_file = None
+        self._keys_file = None
+
+    @staticmethod
+    def text_key(cache_id, text):
+        return hashlib.sha1(f"{cache_id}\0text\0{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def image_key(cache_id, image_path):
+        h = hashlib.sha1(f"{cache_id}\0image\0".encode("utf-8"))
+        with open(image_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def _load(self):
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, "r", encoding="ascii") as f:
+                keys = [line.strip() for line in f if line.strip()]
+        row_bytes = 4 * self.dimension
+        vectors_size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        # Si el proceso murió a mitad de una escritura, descarta las filas incompletas
+        valid = min(len(keys), vectors_size // row_bytes)
+        if valid != len(keys) or vectors_size != valid * row_bytes:
+            print(f"Caché de embeddings: recuperando {valid} filas consistentes tras una escritura interrumpida.")
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(valid * row_bytes)
+            with open(self.keys_path, "w", encoding="ascii") as f:
+                f.writelines(k + "\n" for k in keys[:valid])
+            keys = keys[:valid]
+        self.rows = {k: i for i, k in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def put(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        if self.dimension is None:
+            self.dimension = int(vectors.shape[1])
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump({"dimension": self.dimension}, f)
+        if self._vectors_file is None:
+            self._vectors_file = open(self.vectors_path, "ab")
+            self._keys_file = open(self.keys_path, "a", encoding="ascii")
+        for key, vector in zip(keys, vectors):
+            if key in self.rows:
+                continue
+            # Se escribe primero el vector y luego la clave: una clave nunca apunta a un vector ausente
+            self._vectors_file.write(vector.tobytes())
+            self._keys_file.write(key + "\n")
+            self.rows[key] = len(self.rows)
+
+    def flush(self):
+        # Punto de control: asegura en disco todo lo escrito hasta ahora
+        if self._vectors_file is not None:
+            self._vectors_file.flush()
+            os.fsync(self._vectors_file.fileno())
+            self._keys_file.flush()
+            os.fsync(self._keys_file.fileno())
+
+    def get(self, keys):
+        # Devuelve un array (len(keys), dim) con los vectores de las claves (todas deben existir)
+        if not keys:
+            return np.zeros((0, self.dimension or 0), dtype='float32')
+        self.flush()
+        if self._vectors is None or self._vectors.shape[0] < len(self.rows):
+            self._vectors = np.memmap(self.vectors_path, dtype='float32', mode='r').reshape(-1, self.dimension)
+        return np.asarray(self._vectors[[self.rows[k] for k in keys]])
+
+    def close(self):
+        self.flush()
+        if self._vectors_file is not None:
+            self._vectors_file.close()
+            self._keys_file.close()
+            self._vectors_file = None
+            self._keys_file = None
+        self._vectors = None
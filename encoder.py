@@ -1,37 +1,334 @@
 # encoder.py
+import io
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
 from PIL import Image
 import torch
-from transformers import CLIPProcessor, CLIPModel
+from transformers import CLIPConfig, CLIPProcessor, CLIPTextModelWithProjection, CLIPVisionModelWithProjection
+
+# Backends de inferencia disponibles:
+#   torch       -> modelo PyTorch fp32 (GPU si hay)
+#   torch_int8  -> PyTorch en CPU con las capas lineales cuantizadas dinámicamente a int8
+#   onnx        -> grafo exportado a ONNX y ejecutado con ONNX Runtime (CPU)
+#   onnx_int8   -> como 'onnx', con cuantización dinámica int8 del grafo
+BACKENDS = ("torch", "torch_int8", "onnx", "onnx_int8")
+
+class _TextTower(torch.nn.Module):
+    # Envoltorio para exportar a ONNX: devuelve directamente el embedding proyectado
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).text_embeds
+
+class _VisionTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).image_embeds
+
+def load_image(source, draft_size=None):
+    # Abre una imagen desde una ruta, bytes, un objeto tipo archivo o una imagen PIL ya abierta.
+    # Con `draft_size`, los JPEG grandes se decodifican directamente a una escala reducida
+    # (1/2, 1/4 o 1/8) que sigue cubriendo `draft_size` px: mucho menos trabajo que decodificar
+    # la imagen completa para luego reducirla a 224 px en el preprocesamiento de CLIP.
+    if isinstance(source, Image.Image):
+        return source.convert("RGB")
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with Image.open(source) as img:
+        if draft_size:
+            img.draft("RGB", (draft_size, draft_size))
+        return img.convert("RGB")
 
 class MultimodalEncoder:
-    def __init__(self, model_name="openai/clip-vit-base-patch32"):
-        self.model = CLIPModel.from_pretrained(model_name)
+    def __init__(self, model_name="openai/clip-vit-base-patch32", backend="torch", num_threads=None,
+                 load_text=True, load_vision=True, onnx_dir="onnx_models", fast_decode=True):
+        # load_text / load_vision permiten cargar solo la torre necesaria (p. ej. un proceso
+        # que solo atiende consultas de texto no necesita la torre visual).
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend desconocido: {backend}. Opciones: {', '.join(BACKENDS)}")
+        self.model_name = model_name
+        self.backend = backend
+        self.num_threads = num_threads
         self.processor = CLIPProcessor.from_pretrained(model_name)
-        # Determina si usar GPU (cuda) o CPU
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model.to(self.device)
-        print(f"CLIP model loaded on: {self.device}")
-
-    def encode_image(self, image_path):
-        # Carga y preprocesa la imagen
-        image = Image.open(image_path).convert("RGB")
-        inputs = self.processor(images=image, return_tensors="pt").to(self.device)
-        # Genera el embedding de la imagen
-        with torch.no_grad():
-            image_features = self.model.get_image_features(**inputs)
-        return image_features.cpu().numpy() # Mueve el tensor a CPU y convierte a NumPy
+        self.projection_dim = CLIPConfig.from_pretrained(model_name).projection_dim
+        # Tamaño mínimo al que se decodifican las imágenes en modo borrador (el lado corto que usa CLIP)
+        size = self.processor.image_processor.size
+        self.draft_size = (size.get("shortest_edge") or size.get("height") or 224) if fast_decode else None
+        # Identifica los vectores que produce este encoder en la caché de embeddings: los backends
+        # cuantizados dan vectores distintos a fp32, y la decodificación en borrador también cambia
+        # ligeramente los de imagen
+        self.cache_id = f"{model_name}:{backend}" + (f":draft{self.draft_size}" if self.draft_size else "")
+        # Determina si usar GPU (cuda) o CPU. Los backends cuantizados y ONNX son solo de CPU.
+        self.device = "cuda" if backend == "torch" and torch.cuda.is_available() else "cpu"
+        if num_threads:
+            torch.set_num_threads(num_threads)
 
-    def encode_text(self, text):
-        # Preprocesa el texto
-        inputs = self.processor(text=text, return_tensors="pt", padding=True, truncation=True).to(self.device)
-        # Genera el embedding del texto
+        self.text_model = CLIPTextModelWithProjection.from_pretrained(model_name) if load_text else None
+        self.vision_model = CLIPVisionModelWithProjection.from_pretrained(model_name) if load_vision else None
+        for model in (self.text_model, self.vision_model):
+            if model is not None:
+                model.to(self.device)
+                model.eval()
+
+        if backend == "torch_int8":
+            self.text_model = self._quantize(self.text_model)
+            self.vision_model = self._quantize(self.vision_model)
+        self.text_session = self.vision_session = None
+        if backend in ("onnx", "onnx_int8"):
+            self._load_onnx(onnx_dir, quantize=backend == "onnx_int8")
+
+        # Estadísticas de la última codificación por lotes (items, segundos, items/seg)
+        self.last_encode_stats = None
+        towers = [name for name, loaded in (("text", load_text), ("vision", load_vision)) if loaded]
+        print(f"CLIP model loaded on: {self.device} (backend={backend}, towers={'+'.join(towers)})")
+
+    @property
+    def has_text(self):
+        return self.text_model is not None or self.text_session is not None
+
+    @property
+    def has_vision(self):
+        return self.vision_model is not None or self.vision_session is not None
+
+    @staticmethod
+    def _quantize(model):
+        if model is None:
+            return None
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def _load_onnx(self, onnx_dir, quantize=False):
+        # Exporta las torres a ONNX la primera vez y abre sesiones de ONNX Runtime.
+        # Tras crear la sesión, el modelo PyTorch ya no se necesita y se libera.
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("El backend ONNX necesita 'onnxruntime' (pip install onnxruntime).") from e
+
+        model_dir = os.path.join(onnx_dir, self.model_name.replace("/", "__"))
+        os.makedirs(model_dir, exist_ok=True)
+        options = ort.SessionOptions()
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        if self.text_model is not None:
+            path = self._export_onnx(model_dir, "text", quantize, _TextTower(self.text_model),
+                                     (torch.ones(1, 8, dtype=torch.long), torch.ones(1, 8, dtype=torch.long)),
+                                     ["input_ids", "attention_mask"],
+                                     {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}})
+            self.text_session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self.text_model = None
+        if self.vision_model is not None:
+            size = self.processor.image_processor.crop_size["height"]
+            path = self._export_onnx(model_dir, "vision", quantize, _VisionTower(self.vision_model),
+                                     (torch.zeros(1, 3, size, size),), ["pixel_values"], {"pixel_values": {0: "batch"}})
+            self.vision_session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self.vision_model = None
+
+    @staticmethod
+    def _export_onnx(model_dir, name, quantize, module, dummy_inputs, input_names, dynamic_axes):
+        path = os.path.join(model_dir, f"{name}.onnx")
+        if not os.path.exists(path):
+            print(f"Exportando la torre '{name}' a {path}...")
+            torch.onnx.export(module, dummy_inputs, path + ".tmp", input_names=input_names, output_names=["embeds"],
+                              dynamic_axes={**dynamic_axes, "embeds": {0: "batch"}}, opset_version=17)
+            os.replace(path + ".tmp", path)
+        if not quantize:
+            return path
+        quantized_path = os.path.join(model_dir, f"{name}.int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            print(f"Cuantizando la torre '{name}' a int8 en {quantized_path}...")
+            quantize_dynamic(path, quantized_path + ".tmp", weight_type=QuantType.QInt8)
+            os.replace(quantized_path + ".tmp", quantized_path)
+        return quantized_path
+
+    # --- Preprocesamiento (se ejecuta en los hilos de fondo) ---
+
+    def _prepare_texts(self, texts):
+        # Tokeniza un lote completo de textos de una sola vez
+        return self.processor(text=list(texts), return_tensors="pt", padding=True, truncation=True)
+
+    def _prepare_images(self, images):
+        # Decodifica las imágenes (JPEG -> RGB) y aplica el preprocesamiento de CLIP
+        images = [load_image(image, self.draft_size) for image in images]
+        return self.processor(images=images, return_tensors="pt")
+
+    # --- Pasadas hacia adelante del modelo ---
+
+    def _text_features(self, inputs):
+        if self.text_session is not None:
+            return self.text_session.run(["embeds"], {"input_ids": inputs["input_ids"].numpy().astype(np.int64),
+                                                      "attention_mask": inputs["attention_mask"].numpy().astype(np.int64)})[0]
+        if self.text_model is None:
+            raise RuntimeError("La torre de texto no está cargada (load_text=False).")
+        inputs = inputs.to(self.device)
         with torch.no_grad():
-            text_features = self.model.get_text_features(**inputs)
+            text_features = self.text_model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]).text_embeds
         return text_features.cpu().numpy() # Mueve el tensor a CPU y convierte a NumPy
 
+    def _image_features(self, inputs):
+        if self.vision_session is not None:
+            return self.vision_session.run(["embeds"], {"pixel_values": inputs["pixel_values"].numpy().astype(np.float32)})[0]
+        if self.vision_model is None:
+            raise RuntimeError("La torre visual no está cargada (load_vision=False).")
+        inputs = inputs.to(self.device)
+        with torch.no_grad():
+            image_features = self.vision_model(pixel_values=inputs["pixel_values"]).image_embeds
+        return image_features.cpu().numpy()
+
+    def _encode_pipelined(self, items, batch_size, num_workers, prepare, forward, label):
+        # Divide los elementos en lotes. Mientras el modelo procesa el lote i, los hilos
+        # de fondo ya están tokenizando/decodificando los lotes siguientes.
+        items = list(items)
+        if not items:
+            self.last_encode_stats = {"items": 0, "seconds": 0.0, "items_per_sec": 0.0}
+            return np.zeros((0, self.projection_dim), dtype='float32')
+
+        batch_size = max(1, int(batch_size))
+        num_workers = max(1, int(num_workers))
+        if len(items) <= batch_size:
+            # Un solo lote (p. ej. consultas agrupadas en línea): no hay nada que solapar
+            start = time.perf_counter()
+            embeddings = forward(prepare(items)).astype('float32')
+            elapsed = time.perf_counter() - start
+            self.last_encode_stats = {"items": len(items), "seconds": elapsed, "items_per_sec": len(items) / max(elapsed, 1e-9)}
+            return embeddings
+        batches = (items[i:i + batch_size] for i in range(0, len(items), batch_size))
+        outputs = []
+        done = 0
+        start = time.perf_counter()
+        # El primer lote se prepara en este hilo, antes de arrancar los hilos de fondo: la primera
+        # llamada al tokenizador rápido configura su padding y truncamiento (modifica su estado
+        # interno), y hacerlo mientras otro hilo tokeniza falla con "RuntimeError: Already borrowed".
+        # Las llamadas siguientes usan la misma configuración y ya no lo modifican.
+        first = Future()
+        first.set_result(prepare(next(batches)))
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            pending = deque([first])
+            # Mantiene hasta `num_workers + 1` lotes preparándose por adelantado
+            for batch in batches:
+                pending.append(pool.submit(prepare, batch))
+                if len(pending) > num_workers:
+                    break
+            while pending:
+                inputs = pending.popleft().result()
+                next_batch = next(batches, None)
+                if next_batch is not None:
+                    pending.append(pool.submit(prepare, next_batch))
+                outputs.append(forward(inputs))
+                previous = done
+                done += outputs[-1].shape[0]
+                if done // 5000 != previous // 5000: # Imprimir progreso cada ~5000 elementos
+                    rate = done / max(time.perf_counter() - start, 1e-9)
+                    print(f"Codificando {label} {done}/{len(items)} ({rate:.1f} {label}/s)")
+
+        elapsed = time.perf_counter() - start
+        self.last_encode_stats = {
+            "items": len(items),
+            "seconds": elapsed,
+            "items_per_sec": len(items) / max(elapsed, 1e-9),
+        }
+        return np.concatenate(outputs).astype('float32')
+
+    def encode_image(self, image):
+        # Carga y preprocesa la imagen, y genera su embedding. `image` puede ser una ruta,
+        # bytes, un objeto tipo archivo o una imagen PIL (ver load_image).
+        return self._image_features(self._prepare_images([image]))
+
+    def encode_text(self, text):
+        # Preprocesa el texto y genera su embedding
+        return self._text_features(self.processor(text=text, return_tensors="pt", padding=True, truncation=True))
+
+    def encode_texts(self, texts, batch_size=64, num_workers=2):
+        # Codifica una lista de textos por lotes; devuelve un array (n, dim) float32
+        return self._encode_pipelined(texts, batch_size, num_workers,
+                                      self._prepare_texts, self._text_features, "textos")
+
+    def encode_images(self, image_paths, batch_size=32, num_workers=4):
+        # Codifica una lista de rutas de imagen por lotes; la decodificación JPEG
+        # se hace en paralelo en los hilos de fondo
+        return self._encode_pipelined(image_paths, batch_size, num_workers,
+                                      self._prepare_images, self._image_features, "imágenes")
+
+class FakeEncoder(MultimodalEncoder):
+    # Encoder local sin modelo ni red, para pruebas y mediciones (como generator.FakeBackend):
+    #   - textos: bolsa de palabras con hashing (descripciones con palabras en común quedan cerca)
+    #   - imágenes: proyección aleatoria fija de una miniatura de 8x8 px
+    # No hay alineación entre texto e imagen: mide el sistema, no la calidad de CLIP.
+    def __init__(self, projection_dim=512, seed=0, draft_size=224):
+        self.model_name = f"fake-{projection_dim}"
+        self.backend = "fake"
+        self.cache_id = f"{self.model_name}:fake"
+        self.projection_dim = projection_dim
+        self.draft_size = draft_size
+        self.text_model = self.vision_model = None
+        self.text_session = self.vision_session = None
+        self.last_encode_stats = None
+        rng = np.random.default_rng(seed)
+        self._image_projection = rng.standard_normal((8 * 8 * 3, projection_dim)).astype('float32')
+
+    @property
+    def has_text(self):
+        return True
+
+    @property
+    def has_vision(self):
+        return True
+
+    @staticmethod
+    def _normalize(vectors):
+        return (vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)).astype('float32')
+
+    def _prepare_texts(self, texts):
+        return [text.lower().split() for text in texts]
+
+    def _prepare_images(self, images):
+        pixels = [np.asarray(load_image(image, self.draft_size).resize((8, 8)), dtype=np.float32) for image in images]
+        return np.stack(pixels).reshape(len(pixels), -1) / 255.0 - 0.5
+
+    def _text_features(self, inputs):
+        vectors = np.zeros((len(inputs), self.projection_dim), dtype=np.float32)
+        for row, tokens in enumerate(inputs):
+            for token in tokens:
+                h = zlib.crc32(token.encode("utf-8")) # Hash estable entre procesos (hash() no lo es)
+                vectors[row, h % self.projection_dim] += 1.0 if h & 0x80000000 else -1.0
+        return self._normalize(vectors)
+
+    def _image_features(self, inputs):
+        return self._normalize(inputs @ self._image_projection)
+
+    def encode_text(self, text):
+        return self._text_features(self._prepare_texts([text]))
+
+def encoder_from_env():
+    # Encoder configurado con variables de entorno, para los procesos que sirven consultas:
+    #   ENCODER_BACKEND  -> uno de BACKENDS (por defecto 'torch'), o 'fake' para FakeEncoder
+    #   ENCODER_THREADS  -> número de hilos de inferencia en CPU
+    #   ENCODER_TOWERS   -> 'text' para cargar solo la torre de texto (sin búsqueda por imagen)
+    towers = os.getenv("ENCODER_TOWERS", "text,vision").split(",")
+    if os.getenv("ENCODER_BACKEND") == "fake":
+        return FakeEncoder()
+    return MultimodalEncoder(backend=os.getenv("ENCODER_BACKEND", "torch"),
+                             num_threads=int(os.getenv("ENCODER_THREADS", "0")) or None,
+                             load_text="text" in towers, load_vision="vision" in towers)
+
 if __name__ == '__main__':
     # Pequeña prueba para verificar el encoder
     encoder = MultimodalEncoder()
     print("Encoder initialized. You can now use its methods.")
+    # Prueba rápida del modo por lotes con textos (no requiere imágenes reales)
+    sample_texts = ["a dog running on the beach", "two people riding bikes", "a red car"] * 32
+    embeddings = encoder.encode_texts(sample_texts, batch_size=32)
+    print(f"Embeddings por lotes: {embeddings.shape}, {encoder.last_encode_stats['items_per_sec']:.1f} textos/s")
     # No se recomienda ejecutar pruebas aquí sin una imagen de prueba real
-    # ya que causaría un error si la imagen no existe.
\ No newline at end of file
+    # ya que causaría un error si la imagen no existe.
@@ -1,10 +1,34 @@
 # generator.py
-import google.generativeai as genai
 import os
+import re
+import json
+import hashlib
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv # Si usas .env, sino puedes quitar estas dos líneas
+from cache import LRUCache # Caché de respuestas generadas
+from metrics import metrics # Tiempo de las llamadas al modelo
 
-class TextGenerator:
-    def __init__(self):
+# Configuración de generación compartida por todos los backends
+GENERATION_CONFIG = {
+    "temperature": 0.7,      # Controla la aleatoriedad de la respuesta (0.0 = más determinista, 1.0 = más creativo)
+    "max_output_tokens": 250 # Número máximo de tokens en la respuesta
+}
+
+BLOCKED_MESSAGE = "Lo siento, la respuesta fue bloqueada por los filtros de seguridad del modelo."
+ERROR_MESSAGE = "Lo siento, no pude generar una respuesta en este momento. Hubo un error con el modelo de IA."
+# Respuesta cuando el modelo no responde a tiempo: el cliente recibe igualmente los resultados recuperados
+FALLBACK_MESSAGE = "La generación de la respuesta tardó demasiado. Se muestran solo los resultados recuperados."
+
+class GeminiBackend:
+    # Backend remoto: Google Gemini
+    def __init__(self, model_name="gemini-2.5-flash", request_timeout=20.0):
+        import google.generativeai as genai
+        # Tiempo máximo de cada llamada a la API: sin él, una llamada colgada ocuparía para
+        # siempre un hilo del ejecutor y un hueco de concurrencia de TextGenerator
+        self.request_timeout = request_timeout
+        self.genai = genai
 
         # --- Carga la clave API ---
         # Si estás usando el archivo .env (recomendado):
@@ -19,26 +43,130 @@ class TextGenerator:
         if not GOOGLE_API_KEY:
             raise ValueError("La clave API de Google no se encontró. Asegúrate de que esté configurada como variable de entorno o en un archivo .env, o hardcodeada si es solo para pruebas.")
 
-        # --- CAMBIO IMPORTANTE AQUÍ EN LA INICIALIZACIÓN ---
         # Configura la API de forma global.
         genai.configure(api_key=GOOGLE_API_KEY)
 
         # Selecciona el modelo que quieres usar
-        # Usamos "gemini-2.5-flash" como indicaste
-        self.model_name = "gemini-2.5-flash"
+        self.model_name = model_name
         # Inicializa el modelo generativo directamente con genai.GenerativeModel
         self.model = genai.GenerativeModel(self.model_name)
 
-        print(f"Modelo Gemini '{self.model_name}' inicializado.")
+        # Sin bloqueo por categorías de seguridad
+        self.safety_settings = {
+            genai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+            genai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: genai.types.HarmBlockThreshold.BLOCK_NONE,
+            genai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+            genai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+        }
+
+    def _call(self, prompt, generation_config, stream=False):
+        # Llama al modelo para generar contenido
+        return self.model.generate_content(
+            contents=[{"parts": [{"text": prompt}]}], # Formato de contenidos para generate_content
+            generation_config=generation_config,
+            safety_settings=self.safety_settings,
+            stream=stream,
+            request_options={"timeout": self.request_timeout},
+        )
+
+    def _log_blocked(self, response):
+        # Si no hay partes pero no hubo una excepción, es un bloqueo de seguridad
+        finish_reason = response.candidates[0].finish_reason if response.candidates else "Desconocido"
+        safety_details = []
+        if response.candidates and response.candidates[0].safety_ratings:
+            for rating in response.candidates[0].safety_ratings:
+                safety_details.append(f"{rating.category.name}: {rating.probability.name}")
+        print(f"Respuesta bloqueada por seguridad. Razón: {finish_reason}. Detalles: {', '.join(safety_details) if safety_details else 'N/A'}")
+
+    def generate(self, prompt, generation_config):
+        response = self._call(prompt, generation_config)
+        # Verifica si la respuesta contiene contenido antes de intentar acceder a .text
+        if response.parts:
+            return response.text
+        self._log_blocked(response)
+        return BLOCKED_MESSAGE
+
+    def stream(self, prompt, generation_config):
+        # Emite los fragmentos de texto a medida que el modelo los genera
+        response = self._call(prompt, generation_config, stream=True)
+        emitted = False
+        for chunk in response:
+            if chunk.parts:
+                emitted = True
+                yield chunk.text
+        if not emitted:
+            self._log_blocked(response)
+            yield BLOCKED_MESSAGE
+
+class FakeBackend:
+    # Backend local sin red, para pruebas y mediciones: resume el contexto del prompt
+    # y lo emite palabra por palabra con un retardo configurable.
+    def __init__(self, latency=0.0, token_delay=0.0):
+        self.model_name = "fake"
+        self.latency = latency # Retardo antes del primer token (segundos)
+        self.token_delay = token_delay # Retardo entre tokens (segundos)
+
+    def _answer(self, prompt):
+        context = ""
+        for line in prompt.splitlines():
+            if line.strip().startswith("Contexto: "):
+                context = line.strip()[len("Contexto: "):]
+        words = context.split()[:40]
+        return "Respuesta simulada basada en el contexto: " + " ".join(words)
+
+    def generate(self, prompt, generation_config):
+        time.sleep(self.latency)
+        return self._answer(prompt)
+
+    def stream(self, prompt, generation_config):
+        time.sleep(self.latency)
+        words = self._answer(prompt).split(" ")
+        for i, word in enumerate(words):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield word if i == 0 else " " + word
+
+def make_backend(name=None):
+    # Selecciona el backend con la variable de entorno GENERATOR_BACKEND ('gemini' por defecto, o 'fake')
+    name = name or os.getenv("GENERATOR_BACKEND", "gemini")
+    if name == "gemini":
+        return GeminiBackend(request_timeout=float(os.getenv("GEMINI_REQUEST_TIMEOUT", "20")))
+    if name == "fake":
+        return FakeBackend(token_delay=float(os.getenv("FAKE_GENERATOR_TOKEN_DELAY", "0.02")))
+    raise ValueError(f"Backend de generación desconocido: {name}. Usa 'gemini' o 'fake'.")
 
-    def generate_response(self, query, retrieved_descriptions):
+class TextGenerator:
+    # Además de construir el prompt, controla el acceso al modelo:
+    #   - caché de respuestas por (modelo, consulta normalizada, IDs de descripciones, configuración)
+    #   - peticiones idénticas en curso se agrupan en una sola llamada al modelo
+    #   - como máximo `max_concurrency` llamadas simultáneas; el resto espera en cola
+    #     (hasta `max_queue`) y, si se supera `timeout`, se devuelve FALLBACK_MESSAGE
+    def __init__(self, backend=None, cache_size=512, cache_ttl=600, max_concurrency=4, max_queue=64, timeout=15.0):
+        self.backend = backend or make_backend()
+        self.model_name = self.backend.model_name
+        self.generation_config = dict(GENERATION_CONFIG)
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.response_cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        # Los hilos del ejecutor son las llamadas concurrentes permitidas; su cola interna es la cola de espera
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="generator")
+        # El semáforo se comparte con las respuestas en streaming, que no pasan por el ejecutor
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._inflight = {} # clave -> Future de la llamada en curso
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.rejected = 0
+        print(f"Modelo '{self.model_name}' inicializado.")
+
+    def build_prompt(self, query, retrieved_descriptions):
         # Concatena las descripciones recuperadas para formar un contexto.
         # Filtra descripciones vacías.
         context = "Contexto: " + " ".join([desc for desc in retrieved_descriptions if desc])
 
         # Construye el prompt para el modelo generativo.
-        # Hago el prompt más robusto para guiar mejor a Gemini.
-        prompt_content = f"""
+        return f"""
         Eres un asistente útil y objetivo. Tu tarea es generar una respuesta descriptiva o informativa.
         La respuesta debe ser **estrictamente basada en la información proporcionada en el contexto**.
         No agregues información nueva, opiniones, inferencias, o interpretaciones personales.
@@ -54,42 +182,155 @@ class TextGenerator:
         Respuesta:
         """
 
+    def cache_key(self, query, retrieved_descriptions, retrieved_ids=None):
+        normalized_query = re.sub(r"\s+", " ", query.strip().lower())
+        # Los IDs identifican las descripciones recuperadas; el hash del texto evita reutilizar
+        # una respuesta si, tras reconstruir el índice, un mismo ID apunta a otra descripción.
+        ids_key = tuple(int(i) for i in retrieved_ids) if retrieved_ids is not None else None
+        context_key = (ids_key, hashlib.sha1("\0".join(retrieved_descriptions).encode("utf-8")).hexdigest())
+        return (self.model_name, normalized_query, context_key, json.dumps(self.generation_config, sort_keys=True))
+
+    def stats(self):
+        return {
+            "response_cache": self.response_cache.stats(),
+            "in_flight": len(self._inflight),
+            "queued_or_running": self._pending,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+        }
+
+    def _run_upstream(self, key, prompt, future, deadline):
         try:
-            # Llama al modelo para generar contenido
-            response = self.model.generate_content(
-                contents=[{"parts": [{"text": prompt_content}]}], # Formato de contenidos para generate_content
-                generation_config={
-                    "temperature": 0.7,      # Controla la aleatoriedad de la respuesta (0.0 = más determinista, 1.0 = más creativo)
-                    "max_output_tokens": 250 # Número máximo de tokens en la respuesta
-                },
-                # --- ¡ESTA ES LA SECCIÓN QUE TE FALTABA O ESTABA COMENTADA! ---
-                safety_settings={
-                    genai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                    genai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                    genai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                    genai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                }
-                # -----------------------------------------------------------
-            )
-            # Verifica si la respuesta contiene contenido antes de intentar acceder a .text
-            if response.parts:
-                return response.text
+            # Si todos los que esperaban ya se rindieron, no se llama al modelo
+            if time.monotonic() >= deadline:
+                raise FutureTimeoutError()
+            if not self._slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                raise FutureTimeoutError()
+            try:
+                with metrics.span("generate_upstream"):
+                    text = self.backend.generate(prompt, self.generation_config)
+            finally:
+                self._slots.release()
+            self.response_cache.put(key, text)
+            future.set_result(text)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                self._pending -= 1
+
+    def generate_response(self, query, retrieved_descriptions, retrieved_ids=None, timeout=None):
+        key = self.cache_key(query, retrieved_descriptions, retrieved_ids)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return cached
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                # Ya hay una llamada idéntica en curso: se espera su resultado
+                self.coalesced += 1
+            elif self._pending >= self.max_queue:
+                self.rejected += 1
+                print("Cola de generación llena. Se devuelve solo la recuperación.")
+                return FALLBACK_MESSAGE
             else:
-                # Si no hay partes pero no hubo una excepción, es un bloqueo de seguridad
-                finish_reason = response.candidates[0].finish_reason if response.candidates else "Desconocido"
-                safety_details = []
-                if response.candidates and response.candidates[0].safety_ratings:
-                    for rating in response.candidates[0].safety_ratings:
-                        safety_details.append(f"{rating.category.name}: {rating.probability.name}")
-                print(f"Respuesta bloqueada por seguridad. Razón: {finish_reason}. Detalles: {', '.join(safety_details) if safety_details else 'N/A'}")
-                return "Lo siento, la respuesta fue bloqueada por los filtros de seguridad del modelo."
+                future = Future()
+                self._inflight[key] = future
+                self._pending += 1
+                prompt_content = self.build_prompt(query, retrieved_descriptions)
+                self._executor.submit(self._run_upstream, key, prompt_content, future, deadline)
 
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            self.timeouts += 1
+            print(f"La generación superó el tiempo límite de {timeout:.1f}s.")
+            return FALLBACK_MESSAGE
         except Exception as e:
-            print(f"Error al generar respuesta con Gemini: {e}")
-            return "Lo siento, no pude generar una respuesta en este momento. Hubo un error con el modelo de IA."
+            print(f"Error al generar respuesta con {self.model_name}: {e}")
+            metrics.inc("rag_errors_total", component="generate")
+            return ERROR_MESSAGE
+
+    def generate_response_stream(self, query, retrieved_descriptions, retrieved_ids=None, timeout=None):
+        # Versión en streaming: produce fragmentos de texto a medida que el modelo los emite.
+        # Pasa por la misma admisión que generate_response (cola acotada por `max_queue` y
+        # agrupación de peticiones idénticas en curso). El tiempo límite se aplica a la espera
+        # de un hueco libre (o del resultado de la petición idéntica) antes de emitir nada.
+        key = self.cache_key(query, retrieved_descriptions, retrieved_ids)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = False
+            if future is not None:
+                self.coalesced += 1
+            elif self._pending >= self.max_queue:
+                self.rejected += 1
+            else:
+                future = Future()
+                self._inflight[key] = future
+                self._pending += 1
+                leader = True
+        if future is None:
+            print("Cola de generación llena. Se devuelve solo la recuperación.")
+            yield FALLBACK_MESSAGE
+            return
+        if not leader:
+            # Ya hay una llamada idéntica en curso: se emite su respuesta completa
+            try:
+                yield future.result(timeout=timeout)
+            except FutureTimeoutError:
+                self.timeouts += 1
+                yield FALLBACK_MESSAGE
+            except Exception:
+                yield ERROR_MESSAGE
+            return
+
+        try:
+            if not self._slots.acquire(timeout=timeout):
+                self.timeouts += 1
+                print(f"No hubo hueco para generar en streaming en {timeout:.1f}s.")
+                future.set_exception(FutureTimeoutError())
+                yield FALLBACK_MESSAGE
+                return
+            prompt_content = self.build_prompt(query, retrieved_descriptions)
+            chunks = []
+            start = time.perf_counter()
+            try:
+                for chunk in self.backend.stream(prompt_content, self.generation_config):
+                    if not chunks: # Tiempo hasta el primer fragmento
+                        metrics.observe("rag_stage_duration_seconds", time.perf_counter() - start, stage="generate_first_token")
+                    chunks.append(chunk)
+                    yield chunk
+                text = "".join(chunks)
+                self.response_cache.put(key, text)
+                future.set_result(text)
+            except Exception as e:
+                print(f"Error al generar respuesta en streaming con {self.model_name}: {e}")
+                metrics.inc("rag_errors_total", component="generate_stream")
+                future.set_exception(e)
+                yield ("\n" if chunks else "") + ERROR_MESSAGE
+            finally:
+                self._slots.release()
+        finally:
+            # También si el cliente se desconecta a mitad del streaming (GeneratorExit)
+            if not future.done():
+                future.set_exception(RuntimeError("La generación en streaming se interrumpió."))
+            with self._lock:
+                self._inflight.pop(key, None)
+                self._pending -= 1
 
 if __name__ == '__main__':
-    # Pequeña prueba para verificar el generador con Gemini
+    # Pequeña prueba para verificar el generador (GENERATOR_BACKEND=fake para probar sin red)
     generator = TextGenerator()
     query_example = "What activities are happening based on these images?"
     retrieved_descriptions_example = [
@@ -98,4 +339,8 @@ if __name__ == '__main__':
         "A man is cooking food on a grill outdoors."
     ]
     generated_text = generator.generate_response(query_example, retrieved_descriptions_example)
-    print(f"\nRespuesta Generada por Gemini con {generator.model_name}:\n{generated_text}")
\ No newline at end of file
+    print(f"\nRespuesta Generada por {generator.model_name}:\n{generated_text}")
+    print("\nRespuesta en streaming:")
+    for chunk in generator.generate_response_stream(query_example, retrieved_descriptions_example):
+        print(chunk, end="", flush=True)
+    print()
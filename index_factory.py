@@ -0,0 +1,145 @@
+# index_factory.py
+import math
+import numpy as np
+import faiss
+
+# Tipos de índice soportados por build_index:
+#   flat      -> búsqueda exacta (IndexFlatL2), sin entrenamiento
+#   ivf_flat  -> lista invertida con vectores completos (ajustable con nprobe)
+#   ivf_pq    -> lista invertida con cuantización de producto (muy compacto)
+#   ivf_sq8   -> lista invertida con cuantización escalar int8
+#   hnsw      -> grafo HNSW (ajustable con efSearch), sin entrenamiento
+#   sq8       -> cuantización escalar int8 con búsqueda exhaustiva
+#   sq_fp16   -> vectores en float16 con búsqueda exhaustiva
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "ivf_sq8", "hnsw", "sq8", "sq_fp16")
+# Métrica: 'l2' (distancia, menor es mejor) o 'inner_product' (similitud, mayor es mejor)
+METRICS = {"l2": faiss.METRIC_L2, "inner_product": faiss.METRIC_INNER_PRODUCT}
+
+def default_nlist(num_vectors):
+    # Regla habitual de FAISS: ~4*sqrt(n) listas, con al menos 39 puntos de entrenamiento por lista
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+def default_pq_m(dimension):
+    # Mayor número de subcuantizadores <= d/8 que divide a la dimensión (64 para CLIP ViT-B/32)
+    for m in range(max(1, dimension // 8), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+def create_index(index_type, dimension, num_vectors, nlist=None, pq_m=None, hnsw_m=32, ef_construction=200, metric="l2"):
+    if metric not in METRICS:
+        raise ValueError(f"Métrica desconocida: {metric}. Opciones: {', '.join(METRICS)}")
+    metric_type = METRICS[metric]
+    if index_type == "flat":
+        return faiss.IndexFlat(dimension, metric_type)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, metric_type)
+        index.hnsw.efConstruction = ef_construction
+        return index
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric_type)
+    if index_type == "sq_fp16":
+        return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, metric_type)
+
+    nlist = nlist or default_nlist(num_vectors)
+    quantizer = faiss.IndexFlat(dimension, metric_type)
+    if index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, metric_type)
+    elif index_type == "ivf_sq8":
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit, metric_type)
+    elif index_type == "ivf_pq":
+        pq_m = pq_m or default_pq_m(dimension)
+        # 8 bits por subcuantizador si hay datos suficientes (256 centroides * 39 puntos)
+        nbits = 8 if num_vectors >= 256 * 39 else max(1, min(8, int(math.log2(max(num_vectors // 39, 2)))))
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, nbits, metric_type)
+    else:
+        raise ValueError(f"Tipo de índice desconocido: {index_type}. Opciones: {', '.join(INDEX_TYPES)}")
+    ensure_direct_map(index)
+    return index
+
+def ensure_direct_map(index):
+    # Los índices IVF solo admiten reconstruct (necesario para la búsqueda filtrada por fuerza
+    # bruta, ver search_subset) con un direct map: fila -> (lista, posición), 8 bytes por vector.
+    # Se serializa con el índice; en un índice ya construido sin él se crea recorriendo las listas.
+    if isinstance(index, faiss.IndexIVF) and index.direct_map.no():
+        index.make_direct_map()
+
+def can_reconstruct(index):
+    return not (isinstance(index, faiss.IndexIVF) and index.direct_map.no())
+
+def train_index(index, embeddings, train_size=100000, seed=0):
+    # Entrena el índice (si lo necesita) sobre una muestra aleatoria de los embeddings
+    if index.is_trained:
+        return
+    if len(embeddings) > train_size:
+        rng = np.random.default_rng(seed)
+        sample = embeddings[np.sort(rng.choice(len(embeddings), train_size, replace=False))]
+    else:
+        sample = embeddings
+    print(f"Entrenando índice con {len(sample)} vectores de muestra...")
+    index.train(np.ascontiguousarray(sample, dtype='float32'))
+
+def search_params(index, nprobe=None, ef_search=None, sel=None):
+    # Parámetros de búsqueda por consulta (no modifican el índice compartido, así que
+    # son seguros con varias consultas concurrentes). Devuelve None si no aplican.
+    # `sel` es un faiss.IDSelector que restringe la búsqueda a un subconjunto de filas.
+    if isinstance(index, faiss.IndexIVF) and (nprobe is not None or sel is not None):
+        params = faiss.SearchParametersIVF(sel=sel) if sel is not None else faiss.SearchParametersIVF()
+        if nprobe is not None:
+            params.nprobe = int(nprobe)
+        return params
+    if isinstance(index, faiss.IndexHNSW) and (ef_search is not None or sel is not None):
+        params = faiss.SearchParametersHNSW(sel=sel) if sel is not None else faiss.SearchParametersHNSW()
+        if ef_search is not None:
+            params.efSearch = int(ef_search)
+        return params
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+def subset_path(index, ids, brute_force_threshold=2048):
+    # Estrategia que sigue search_subset para un subconjunto de filas:
+    #   'brute_force'           -> distancias exactas sobre los vectores reconstruidos (subconjunto pequeño)
+    #   'id_selector_all_lists' -> subconjunto pequeño en un IVF sin direct map: selector de IDs
+    #                              recorriendo todas las listas (con el nprobe habitual casi nunca
+    #                              caerían las pocas filas permitidas en las listas visitadas)
+    #   'id_selector'           -> búsqueda normal de FAISS restringida con un selector de IDs
+    if len(ids) <= brute_force_threshold:
+        return "brute_force" if can_reconstruct(index) else "id_selector_all_lists"
+    return "id_selector"
+
+def search_subset(index, queries, k, ids, brute_force_threshold=2048, nprobe=None, ef_search=None):
+    # Búsqueda restringida a las filas `ids` (array ordenado). Devuelve (distancias, índices)
+    # con la misma forma que index.search, rellenando con -1 si hay menos de k candidatos.
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    path = subset_path(index, ids, brute_force_threshold)
+    if path == "brute_force":
+        # Subconjunto pequeño: distancias exactas sobre los vectores reconstruidos.
+        # faiss.knn calcula las distancias L2 por bloques (||q||² - 2·q·v + ||v||²), o los
+        # productos escalares, sin materializar un array (consultas x filas x dimensión)
+        n = min(k, len(ids))
+        inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+        out_distances = np.full((len(queries), k), -np.inf if inner_product else np.inf, dtype='float32')
+        out_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if n > 0:
+            vectors = index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+            distances, positions = faiss.knn(queries, np.ascontiguousarray(vectors, dtype='float32'), n,
+                                             metric=index.metric_type)
+            out_distances[:, :n] = distances
+            out_indices[:, :n] = np.asarray(ids, dtype=np.int64)[positions]
+        return out_distances, out_indices
+    if path == "id_selector_all_lists":
+        nprobe = index.nlist
+    # Búsqueda normal de FAISS restringida con un bitmap de filas permitidas
+    mask = np.zeros(index.ntotal, dtype=bool)
+    mask[ids] = True
+    bitmap = np.packbits(mask, bitorder='little')
+    selector = faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(bitmap))
+    params = search_params(index, nprobe=nprobe, ef_search=ef_search, sel=selector)
+    distances, indices = index.search(queries, k, params=params)
+    del bitmap # El selector apunta a este buffer: debe seguir vivo hasta terminar la búsqueda
+    return distances, indices
+
+def index_memory_bytes(index):
+    # Tamaño serializado del índice: buena aproximación de su huella en memoria
+    return int(faiss.serialize_index(index).nbytes)
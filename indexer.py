@@ -1,87 +1,448 @@
 # indexer.py
 import os
+import re
+import hashlib
+import shutil
+import time
 import numpy as np
 import faiss
 import pandas as pd # Importar pandas para leer CSV
 from encoder import MultimodalEncoder # Importar la clase MultimodalEncoder
+from embedding_cache import EmbeddingCache # Caché de embeddings en disco
+from index_factory import create_index, train_index, ensure_direct_map # Tipos de índice FAISS configurables
+from metadata_store import MetadataStoreWriter, load_metadata # Metadatos columnares con mmap
+from thumbnails import generate_thumbnails # Miniaturas para servir en /search
 
-def build_index(image_folder, annotations_file, encoder, index_path="faiss_index.bin", metadata_path="metadata.npy", limit=1000):
+ANNOTATION_COLUMNS = ['image_name', 'comment_number', 'comment']
+
+def scan_image_folder(image_folder):
+    # Lista la carpeta de imágenes una sola vez: comprobar la existencia en un set evita
+    # una llamada a os.path.exists por fila (muy costosa en almacenamiento de red)
+    with os.scandir(image_folder) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
+
+def resolve_image_path(image_id, image_folder, available):
+    # Ruta de la imagen si existe. Intentar con .jpg si no se especifica.
+    if os.sep in image_id or (os.altsep and os.altsep in image_id):
+        # IDs con subcarpetas: no están en el listado de primer nivel
+        for name in (image_id, image_id + '.jpg'):
+            if os.path.exists(os.path.join(image_folder, name)):
+                return os.path.join(image_folder, name)
+        return None
+    if image_id in available:
+        return os.path.join(image_folder, image_id)
+    if not image_id.lower().endswith('.jpg') and image_id + '.jpg' in available:
+        return os.path.join(image_folder, image_id + '.jpg')
+    return None
+
+def select_rows(df, image_folder, available, unique_images, limit=1000, skip=None):
+    # Filtra un bloque del CSV: devuelve (image_paths, image_ids, descriptions) de las filas cuya
+    # imagen existe, sin superar `limit` imágenes únicas. `unique_images` se actualiza en el sitio,
+    # de modo que el límite se respeta a lo largo de varios bloques.
     image_paths = []
     image_ids = []
     descriptions = []
+    for image_name, comment in zip(df['image_name'], df['comment']):
+        # Si el límite está activo y ya hemos procesado suficientes imágenes únicas, salir
+        if limit and len(unique_images) >= limit:
+            break
+
+        image_id = str(image_name).strip() # Para Flickr30k, image_name ya es el ID completo del archivo
+        desc = str(comment).strip() # Asegurarse de que sea string y limpiar espacios
 
+        # Saltar filas que ya están en el índice (modo 'append')
+        if skip and (image_id, desc) in skip:
+            continue
+
+        full_image_path = resolve_image_path(image_id, image_folder, available)
+        if full_image_path is None:
+            continue # Saltar esta entrada si la imagen no existe
+
+        image_paths.append(full_image_path)
+        image_ids.append(image_id)
+        descriptions.append(desc)
+        unique_images.add(image_id)
+    return image_paths, image_ids, descriptions
+
+class RowHashSet:
+    # Conjunto compacto de pares (image_id, description) ya indexados (modo 'append'): un hash
+    # de 64 bits por fila en un array ordenado (8 bytes por fila, en lugar de una tupla de strings)
+    def __init__(self, pairs):
+        self._hashes = np.unique(np.fromiter((self._hash(image_id, desc) for image_id, desc in pairs), dtype=np.uint64))
+
+    @staticmethod
+    def _hash(image_id, description):
+        digest = hashlib.blake2b(f"{image_id}\0{description}".encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, pair):
+        h = np.uint64(self._hash(*pair))
+        i = int(np.searchsorted(self._hashes, h))
+        return i < len(self._hashes) and self._hashes[i] == h
+
+def load_annotations(image_folder, annotations_file, limit=1000, skip=None):
+    # Lee el CSV de anotaciones y devuelve (image_paths, image_ids, descriptions) de las filas
+    # cuya imagen existe. `skip` es un conjunto opcional de pares (image_id, description) ya indexados
+    # (un set o un RowHashSet).
     print(f"Cargando anotaciones desde {annotations_file}...")
     # Leer el archivo CSV usando pandas, asumiendo el formato 'image_name|comment_number|comment'
-    df = pd.read_csv(annotations_file, sep='|', header=None, names=['image_name', 'comment_number', 'comment'])
+    df = pd.read_csv(annotations_file, sep='|', header=None, names=ANNOTATION_COLUMNS)
 
-    processed_images_count = 0
     unique_images_processed = set()
+    image_paths, image_ids, descriptions = select_rows(df, image_folder, scan_image_folder(image_folder),
+                                                       unique_images_processed, limit=limit, skip=skip)
 
-    # Itera sobre las filas del DataFrame
-    for index, row in df.iterrows():
-        # Si el límite está activo y ya hemos procesado suficientes imágenes únicas, salir
-        if limit and len(unique_images_processed) >= limit:
-            break
+    print(f"Procesando {len(unique_images_processed)} imágenes únicas y {len(descriptions)} descripciones.")
+    return image_paths, image_ids, descriptions
 
-        image_filename_raw = str(row['image_name']).strip() # Asegurarse de que sea string y limpiar espacios
-        desc = str(row['comment']).strip() # Asegurarse de que sea string y limpiar espacios
+def count_lines(path):
+    # Cota superior del número de filas del CSV, sin parsearlo
+    with open(path, "rb") as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b"")) + 1
 
-        image_id = image_filename_raw # Para Flickr30k, image_name ya es el ID completo del archivo
+def _encode_cached(keys, items, encode_fn, cache, checkpoint_every, label):
+    # Codifica solo los elementos cuya clave no está en la caché, y asegura la caché en disco
+    # cada `checkpoint_every` elementos: si el proceso se interrumpe, la siguiente ejecución
+    # retoma desde ahí. Devuelve los vectores de todas las claves, en orden.
+    # Elementos pendientes (sin duplicados), en el orden en que aparecen
+    pending = {}
+    for key, item in zip(keys, items):
+        if key not in cache and key not in pending:
+            pending[key] = item
+    print(f"Caché de embeddings: {len(keys) - len(pending)} {label} ya codificadas, {len(pending)} pendientes.")
 
-        full_image_path = os.path.join(image_folder, image_id)
+    pending_keys = list(pending)
+    checkpoint_every = max(1, int(checkpoint_every))
+    for start in range(0, len(pending_keys), checkpoint_every):
+        chunk_keys = pending_keys[start:start + checkpoint_every]
+        chunk_embeddings, rate = encode_fn([pending[k] for k in chunk_keys])
+        cache.put(chunk_keys, chunk_embeddings)
+        cache.flush()
+        print(f"Checkpoint: {start + len(chunk_keys)}/{len(pending_keys)} {label} nuevas codificadas ({rate:.1f} {label}/s)")
 
-        # Verificar si el archivo de imagen existe. Intentar con .jpg si no se especifica.
-        if not os.path.exists(full_image_path):
-            if not image_id.lower().endswith('.jpg'):
-                full_image_path = os.path.join(image_folder, image_id + '.jpg')
-            if not os.path.exists(full_image_path):
-                # print(f"Archivo de imagen no encontrado para: {image_id}. Saltando entrada.")
-                continue # Saltar esta entrada si la imagen no existe
+    return cache.get(keys)
 
-        # Solo agregar si no hemos alcanzado el límite de imágenes únicas
-        if limit and image_id not in unique_images_processed and len(unique_images_processed) >= limit:
-            continue
+def encode_descriptions(encoder, descriptions, cache=None, batch_size=64, num_workers=2, checkpoint_every=5000):
+    # Codifica las descripciones por lotes (con caché de embeddings si se proporciona)
+    def encode_fn(texts):
+        embeddings = encoder.encode_texts(texts, batch_size=batch_size, num_workers=num_workers)
+        return embeddings, encoder.last_encode_stats['items_per_sec']
 
-        image_paths.append(full_image_path)
-        image_ids.append(image_id)
-        descriptions.append(desc)
-        unique_images_processed.add(image_id)
-        processed_images_count += 1
+    if cache is None:
+        print(f"Codificando {len(descriptions)} descripciones (batch_size={batch_size}, num_workers={num_workers})...")
+        embeddings, rate = encode_fn(descriptions)
+        stats = encoder.last_encode_stats
+        print(f"Codificación completada: {stats['items']} descripciones en {stats['seconds']:.1f}s ({rate:.1f} descripciones/s)")
+        return embeddings
 
-    print(f"Procesando {len(unique_images_processed)} imágenes únicas y {len(descriptions)} descripciones.")
+    cache_id = getattr(encoder, "cache_id", getattr(encoder, "model_name", "unknown"))
+    keys = [EmbeddingCache.text_key(cache_id, desc) for desc in descriptions]
+    return _encode_cached(keys, descriptions, encode_fn, cache, checkpoint_every, "descripciones")
+
+def encode_image_files(encoder, image_paths, cache=None, batch_size=32, num_workers=4, checkpoint_every=5000):
+    # Codifica imágenes con la torre visual de CLIP (con caché por hash de los bytes de la imagen)
+    def encode_fn(paths):
+        embeddings = encoder.encode_images(paths, batch_size=batch_size, num_workers=num_workers)
+        return embeddings, encoder.last_encode_stats['items_per_sec']
+
+    if cache is None:
+        print(f"Codificando {len(image_paths)} imágenes...")
+        return encode_fn(image_paths)[0]
+
+    cache_id = getattr(encoder, "cache_id", getattr(encoder, "model_name", "unknown"))
+    keys = [EmbeddingCache.image_key(cache_id, path) for path in image_paths]
+    return _encode_cached(keys, image_paths, encode_fn, cache, checkpoint_every, "imágenes")
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype('float32')
+
+def image_level_vectors(image_order, image_paths_by_id, caption_image_ids, caption_embeddings, encoder, cache=None,
+                        image_vector="mean", fusion_weight=0.5, batch_size=64, num_workers=2, checkpoint_every=5000):
+    # Un vector por imagen, en el orden de `image_order`:
+    #   'mean'  -> media de los embeddings normalizados de sus descripciones (normalizada)
+    #   'clip'  -> embedding de la imagen con la torre visual de CLIP (normalizado)
+    #   'fused' -> w*media + (1-w)*imagen, SIN normalizar, para un índice de producto escalar: con la
+    #              consulta normalizada, q·(w*m + (1-w)*c) = w*sim(q, m) + (1-w)*sim(q, c), es decir,
+    #              la fusión lineal de las dos similitudes (ver image_level_metric)
+    position = {image_id: i for i, image_id in enumerate(image_order)}
+    mean_vectors = clip_vectors = None
+    if image_vector in ("mean", "fused"):
+        rows = np.array([position.get(image_id, -1) for image_id in caption_image_ids])
+        keep = rows >= 0
+        sums = np.zeros((len(image_order), caption_embeddings.shape[1]), dtype='float32')
+        np.add.at(sums, rows[keep], normalize_rows(caption_embeddings[keep]))
+        mean_vectors = normalize_rows(sums)
+    if image_vector in ("clip", "fused"):
+        clip_vectors = normalize_rows(encode_image_files(encoder, [image_paths_by_id[i] for i in image_order], cache=cache,
+                                                         batch_size=batch_size, num_workers=num_workers,
+                                                         checkpoint_every=checkpoint_every))
+    if image_vector == "mean":
+        return mean_vectors
+    if image_vector == "clip":
+        return clip_vectors
+    return (fusion_weight * mean_vectors + (1 - fusion_weight) * clip_vectors).astype('float32')
+
+def image_level_metric(image_vector):
+    # Los vectores normalizados se buscan por L2 (mismo orden que la similitud coseno); los
+    # 'fused' necesitan el producto escalar para que la puntuación sea la suma ponderada
+    return "inner_product" if image_vector == "fused" else "l2"
+
+def publish_index(index, writer, index_path, keep_versions=2):
+    # Publica una nueva versión del índice de forma atómica:
+    #   1. el índice se escribe en un archivo inmutable con la versión en el nombre
+    #      (faiss_index.<versión>.bin), junto a `index_path`
+    #   2. los metadatos (que incluyen la versión y el nombre de ese archivo) se escriben en un
+    #      directorio temporal y se publican con un rename
+    # Los procesos que sirven consultas leen primero los metadatos y después el índice que
+    # estos indican, así que nunca combinan un índice y unos metadatos de versiones distintas.
+    root, ext = os.path.splitext(index_path)
+    versioned_path = f"{root}.{writer.version}{ext}"
+    faiss.write_index(index, versioned_path + ".tmp")
+    os.replace(versioned_path + ".tmp", versioned_path)
+
+    writer.extra["index_file"] = os.path.basename(versioned_path)
+    writer.finish()
+    # `index_path` se mantiene como copia de la última versión (para herramientas y benchmarks)
+    shutil.copyfile(versioned_path, index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+    writer.publish()
+
+    # Borra versiones antiguas. Los procesos que aún las tengan mapeadas en memoria
+    # siguen leyéndolas sin problema hasta que recarguen.
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.(\d+)" + re.escape(ext) + "$")
+    directory = os.path.dirname(os.path.abspath(index_path))
+    versions = sorted((int(m.group(1)), name) for name in os.listdir(directory) if (m := pattern.match(name)))
+    for _, name in versions[:-keep_versions]:
+        os.remove(os.path.join(directory, name))
+
+def save_index(index, metadata, index_path, metadata_path, image_folder, extra=None, keep_versions=2):
+    writer = MetadataStoreWriter(metadata_path, image_folder, extra=dict(extra or {}))
+    writer.extend(metadata)
+    publish_index(index, writer, index_path, keep_versions=keep_versions)
+
+def build_index_streaming(image_folder, annotations_file, encoder, index_path="faiss_index.bin", metadata_path="metadata_store",
+                          limit=1000, batch_size=64, num_workers=2, cache_dir="embedding_cache", checkpoint_every=5000,
+                          mode="rebuild", index_type="flat", train_size=100000, nlist=None, pq_m=None, hnsw_m=32,
+                          thumbnail_dir="thumbnails", thumbnail_width=256, thumbnail_format="webp", chunk_size=10000):
+    # Construcción por bloques (solo nivel 'caption'): el CSV se lee por bloques de `chunk_size`
+    # filas, los embeddings se escriben en un archivo float32 mapeado en memoria y preasignado,
+    # los metadatos se escriben de forma incremental y los vectores se añaden a FAISS por bloques.
+    # Ni los embeddings ni el texto del corpus se acumulan en memoria, pero sí crecen con él:
+    #   - el índice FAISS (usa un tipo compacto como 'ivf_pq' o 'sq8' para corpus muy grandes)
+    #   - los offsets e índices de imagen de los metadatos (~12 bytes por descripción) y las listas
+    #     del índice invertido (4 bytes por palabra distinta de cada descripción), hasta finish()
+    #   - el conjunto de imágenes vistas y, en modo 'append', 8 bytes por descripción ya indexada
+    #   - la caché de embeddings, si se usa: guarda en un dict una clave por vector (~150-200 bytes
+    #     por descripción). Para corpus muy grandes, desactívala con cache_dir=None.
+    index = None
+    skip = None
+    existing = None
+    if mode == "append" and os.path.exists(index_path) and os.path.exists(metadata_path):
+        index = faiss.read_index(index_path)
+        ensure_direct_map(index) # Índices IVF construidos antes de que create_index lo añadiera
+        existing = load_metadata(metadata_path)
+        if getattr(existing, "info", {}).get("level", "caption") != "caption":
+            raise ValueError("La construcción en streaming solo admite índices de nivel 'caption'.")
+        skip = RowHashSet((item["image_id"], item["description"]) for item in existing)
+        print(f"Modo 'append': índice existente con {index.ntotal} elementos.")
+
+    writer = MetadataStoreWriter(metadata_path, image_folder)
+    embeddings_path = index_path + ".embeddings.tmp"
+    embeddings = None
+    cache = None
+    published = False
+    try:
+        if existing is not None:
+            writer.extend(existing) # Se copia fila a fila, sin cargar todo en memoria
+
+        available = scan_image_folder(image_folder)
+        dimension = encoder.projection_dim
+        max_rows = count_lines(annotations_file)
+        embeddings = np.lib.format.open_memmap(embeddings_path, mode="w+", dtype=np.float32, shape=(max_rows, dimension))
+        cache = EmbeddingCache(cache_dir) if cache_dir else None
+        unique_images = set()
+        total = 0
+        start = time.perf_counter()
+        print(f"Leyendo anotaciones desde {annotations_file} en bloques de {chunk_size} filas...")
+        chunks = pd.read_csv(annotations_file, sep='|', header=None, names=ANNOTATION_COLUMNS, chunksize=chunk_size)
+        for chunk in chunks:
+            if limit and len(unique_images) >= limit:
+                break
+            image_paths, image_ids, descriptions = select_rows(chunk, image_folder, available, unique_images,
+                                                               limit=limit, skip=skip)
+            if not descriptions:
+                continue
+            vectors = encode_descriptions(encoder, descriptions, cache=cache, batch_size=batch_size,
+                                          num_workers=num_workers, checkpoint_every=checkpoint_every)
+            embeddings[total:total + len(vectors)] = vectors
+            for img_path, img_id, desc in zip(image_paths, image_ids, descriptions):
+                writer.add(img_path, img_id, desc)
+            if thumbnail_dir:
+                generate_thumbnails(zip(image_ids, image_paths), thumbnail_dir, width=thumbnail_width, fmt=thumbnail_format)
+            total += len(vectors)
+            print(f"{total} descripciones procesadas ({total / max(time.perf_counter() - start, 1e-9):.1f} descripciones/s)")
+        if cache is not None:
+            cache.close() # Libera su diccionario de claves antes de construir el índice
+            cache = None
+
+        if total == 0:
+            print("No hay filas nuevas que añadir al índice." if index is not None else
+                  "Advertencia: No se encontraron descripciones válidas o imágenes. Verifique las rutas y el formato del CSV.")
+            return
+        embeddings.flush()
+        if index is None:
+            print(f"Construyendo índice FAISS '{index_type}' con {total} embeddings de dimensión {dimension}")
+            index = create_index(index_type, dimension, total, nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
+            # train_index toma una muestra aleatoria: solo esas filas se leen del archivo mapeado
+            train_index(index, embeddings[:total], train_size=train_size)
+        for offset in range(0, total, chunk_size):
+            index.add(np.ascontiguousarray(embeddings[offset:min(offset + chunk_size, total)]))
+
+        extra = {"level": "caption", "normalized": False}
+        if thumbnail_dir:
+            extra["thumbnails"] = {"dir": thumbnail_dir, "width": thumbnail_width, "format": thumbnail_format}
+        writer.extra.update(extra)
+        publish_index(index, writer, index_path)
+        published = True
+        print(f"Índice FAISS guardado en {index_path} ({index.ntotal} elementos)")
+        print(f"Metadatos guardados en {metadata_path}")
+        print(f"Imágenes únicas procesadas: {len(unique_images)}")
+    finally:
+        # Si algo falla (o no hay nada que añadir), no quedan ni el archivo de embeddings
+        # temporal (puede ocupar varios GB) ni el directorio temporal de metadatos
+        if cache is not None:
+            cache.close()
+        if not published:
+            writer.abort()
+        if embeddings is not None:
+            del embeddings
+        if os.path.exists(embeddings_path):
+            os.remove(embeddings_path)
+
+def build_index(image_folder, annotations_file, encoder, index_path="faiss_index.bin", metadata_path="metadata_store", limit=1000,
+                batch_size=64, num_workers=2, cache_dir="embedding_cache", checkpoint_every=5000, mode="rebuild",
+                index_type="flat", train_size=100000, nlist=None, pq_m=None, hnsw_m=32,
+                thumbnail_dir="thumbnails", thumbnail_width=256, thumbnail_format="webp",
+                level="caption", image_vector="mean", fusion_weight=0.5, streaming=False, chunk_size=10000):
+    # mode='rebuild': construye el índice desde cero (reutilizando la caché de embeddings).
+    # mode='append': codifica solo las filas nuevas del CSV y las añade al índice y metadatos existentes.
+    # index_type: 'flat' (exacto), 'ivf_flat', 'ivf_pq', 'ivf_sq8', 'hnsw', 'sq8' o 'sq_fp16'
+    # (ver index_factory.py). Los índices IVF/PQ/SQ se entrenan con una muestra de `train_size` vectores.
+    # thumbnail_dir: carpeta donde se generan miniaturas de `thumbnail_width` px para /search (None para omitirlas).
+    # level='caption': un vector por descripción. level='image': un vector por imagen (ver image_level_vectors,
+    # `image_vector` = 'mean', 'clip' o 'fused'); las descripciones se guardan como contenido de cada imagen.
+    # En modo 'append' a nivel de imagen solo se añaden vectores para imágenes nuevas.
+    if mode not in ("rebuild", "append"):
+        raise ValueError(f"Modo desconocido: {mode}. Usa 'rebuild' o 'append'.")
+    if level not in ("caption", "image"):
+        raise ValueError(f"Nivel desconocido: {level}. Usa 'caption' o 'image'.")
+    if image_vector not in ("mean", "clip", "fused"):
+        raise ValueError(f"Vector de imagen desconocido: {image_vector}. Usa 'mean', 'clip' o 'fused'.")
+    if streaming:
+        # streaming=True: lectura por bloques y memoria acotada (ver build_index_streaming)
+        if level != "caption":
+            raise ValueError("La construcción en streaming solo admite level='caption'.")
+        return build_index_streaming(image_folder, annotations_file, encoder, index_path=index_path, metadata_path=metadata_path,
+                                     limit=limit, batch_size=batch_size, num_workers=num_workers, cache_dir=cache_dir,
+                                     checkpoint_every=checkpoint_every, mode=mode, index_type=index_type, train_size=train_size,
+                                     nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m, thumbnail_dir=thumbnail_dir,
+                                     thumbnail_width=thumbnail_width, thumbnail_format=thumbnail_format, chunk_size=chunk_size)
+
+    index = None
+    metadata = []
+    skip = None
+    if mode == "append":
+        if os.path.exists(index_path) and os.path.exists(metadata_path):
+            index = faiss.read_index(index_path)
+            ensure_direct_map(index) # Índices IVF construidos antes de que create_index lo añadiera
+            existing = load_metadata(metadata_path)
+            existing_level = getattr(existing, "info", {}).get("level", "caption")
+            if existing_level != level:
+                raise ValueError(f"El índice existente es de nivel '{existing_level}', no '{level}'.")
+            existing_vector = getattr(existing, "info", {}).get("image_vector", "mean")
+            if level == "image" and existing_vector != image_vector:
+                raise ValueError(f"El índice existente usa image_vector='{existing_vector}', no '{image_vector}'.")
+            metadata = list(existing)
+            skip = RowHashSet((item["image_id"], item["description"]) for item in metadata)
+            print(f"Modo 'append': índice existente con {index.ntotal} elementos.")
+        else:
+            print("Modo 'append': no existe un índice previo, se construirá uno nuevo.")
+
+    image_paths, image_ids, descriptions = load_annotations(image_folder, annotations_file, limit=limit, skip=skip)
     if len(descriptions) == 0:
-        print("Advertencia: No se encontraron descripciones válidas o imágenes. Verifique las rutas y el formato del CSV.")
+        if index is not None:
+            print("No hay filas nuevas que añadir al índice.")
+        else:
+            print("Advertencia: No se encontraron descripciones válidas o imágenes. Verifique las rutas y el formato del CSV.")
         return # Salir si no hay datos para procesar
 
-    all_embeddings = []
-    metadata = [] # Para almacenar image_path, image_id y description
+    # Metadatos para cada descripción: image_path, image_id y description
+    new_metadata = [{"image_path": img_path, "image_id": img_id, "description": desc}
+                    for img_path, img_id, desc in zip(image_paths, image_ids, descriptions)]
 
-    # Codificar descripciones y asociarlas con las rutas de las imágenes
-    for i, (img_path, img_id, desc) in enumerate(zip(image_paths, image_ids, descriptions)):
-        if i % 500 == 0: # Imprimir progreso cada 500 descripciones
-            print(f"Codificando descripción {i}/{len(descriptions)}")
-        text_embedding = encoder.encode_text(desc)
-        all_embeddings.append(text_embedding.flatten()) # Aplanar a 1D para FAISS
-        metadata.append({"image_path": img_path, "image_id": img_id, "description": desc})
-
-    embeddings_array = np.array(all_embeddings).astype('float32')
+    cache = EmbeddingCache(cache_dir) if cache_dir else None
+    try:
+        if level == "image" and image_vector == "clip":
+            caption_embeddings = None # No hace falta codificar las descripciones
+        else:
+            caption_embeddings = encode_descriptions(encoder, descriptions, cache=cache, batch_size=batch_size,
+                                                     num_workers=num_workers, checkpoint_every=checkpoint_every)
+        if level == "caption":
+            embeddings_array = caption_embeddings
+        else:
+            # Imágenes nuevas, en orden de primera aparición (el mismo orden en que las interna el almacén de metadatos)
+            known_images = {item["image_id"] for item in metadata}
+            image_order = [i for i in dict.fromkeys(image_ids) if i not in known_images]
+            embeddings_array = image_level_vectors(image_order, dict(zip(image_ids, image_paths)), image_ids, caption_embeddings,
+                                                   encoder, cache=cache, image_vector=image_vector, fusion_weight=fusion_weight,
+                                                   batch_size=batch_size, num_workers=num_workers, checkpoint_every=checkpoint_every)
+    finally:
+        if cache is not None:
+            cache.close()
 
     if len(embeddings_array) == 0:
-        print("No se generaron embeddings. Verifique las rutas de sus datos y límites.")
-        return
+        if level == "image" and index is not None:
+            # Solo hay descripciones nuevas de imágenes ya indexadas: se guardan como contenido
+            print("No hay imágenes nuevas; solo se añaden las descripciones a los metadatos.")
+        else:
+            print("No se generaron embeddings. Verifique las rutas de sus datos y límites.")
+            return
+
+    dimension = embeddings_array.shape[1] if len(embeddings_array) else index.d
+    if index is None:
+        print(f"Construyendo índice FAISS '{index_type}' con {embeddings_array.shape[0]} embeddings de dimensión {dimension}")
+        metric = image_level_metric(image_vector) if level == "image" else "l2"
+        index = create_index(index_type, dimension, len(embeddings_array), nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m,
+                             metric=metric)
+        train_index(index, embeddings_array, train_size=train_size)
+    elif index.d != dimension:
+        raise ValueError(f"El índice existente tiene dimensión {index.d}, pero los embeddings nuevos tienen {dimension}.")
+    else:
+        print(f"Añadiendo {embeddings_array.shape[0]} embeddings al índice existente")
+    if len(embeddings_array):
+        index.add(embeddings_array)
+    metadata.extend(new_metadata)
 
-    print(f"Construyendo índice FAISS con {embeddings_array.shape[0]} embeddings de dimensión {embeddings_array.shape[1]}")
-    dimension = embeddings_array.shape[1]
-    index = faiss.IndexFlatL2(dimension) # Usar IndexFlatL2 para búsqueda de vecinos más cercanos (distancia euclidiana)
-    index.add(embeddings_array)
+    # A nivel de imagen los vectores están normalizados, y el Retriever debe normalizar las consultas
+    extra = {"level": level, "normalized": level == "image"}
+    if level == "image":
+        extra["image_vector"] = image_vector
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            extra["metric"] = "inner_product" # El Retriever trata las puntuaciones como similitudes
+    if thumbnail_dir:
+        generate_thumbnails(zip(image_ids, image_paths), thumbnail_dir, width=thumbnail_width, fmt=thumbnail_format)
+        extra["thumbnails"] = {"dir": thumbnail_dir, "width": thumbnail_width, "format": thumbnail_format}
 
     # Guardar el índice y los metadatos
-    faiss.write_index(index, index_path)
-    np.save(metadata_path, metadata)
+    save_index(index, metadata, index_path, metadata_path, image_folder, extra=extra)
 
-    print(f"Índice FAISS guardado en {index_path}")
+    print(f"Índice FAISS guardado en {index_path} ({index.ntotal} elementos)")
     print(f"Metadatos guardados en {metadata_path}")
-    print(f"Imágenes únicas procesadas: {len(unique_images_processed)}")
+    print(f"Imágenes únicas procesadas: {len(set(image_ids))}")
 
 
 if __name__ == '__main__':
@@ -103,4 +464,12 @@ if __name__ == '__main__':
     encoder = MultimodalEncoder()
     # Puedes ajustar el 'limit' para procesar más o menos imágenes.
     # Flickr30k es un dataset grande, 1000 imágenes únicas es un buen punto de partida para pruebas.
-    build_index(IMAGE_FOLDER, ANNOTATIONS_FILE, encoder, limit=4000)
\ No newline at end of file
+    # 'batch_size' controla cuántas descripciones se codifican por pasada de CLIP; ajústalo
+    # según la máquina usando la cifra de descripciones/s que se imprime al final.
+    # Si la construcción se interrumpe, vuelve a ejecutar este script: los embeddings ya
+    # guardados en 'embedding_cache/' no se recalculan. Usa mode="append" para añadir
+    # solo las filas nuevas del CSV a un índice existente.
+    # Para corpus grandes, prueba index_type="ivf_flat" o "hnsw"; usa
+    # 'python -m benchmarks.index_recall' para comparar recall, memoria y latencia.
+    # Con streaming=True el CSV se procesa por bloques y la memoria no crece con el corpus.
+    build_index(IMAGE_FOLDER, ANNOTATIONS_FILE, encoder, limit=4000, batch_size=64, index_type="flat")
@@ -0,0 +1,159 @@
+# inverted_index.py
+import os
+import re
+from array import array
+import numpy as np
+
+# Índice invertido compacto sobre las descripciones: token -> lista ordenada de IDs de descripción.
+# Se guarda dentro del directorio del almacén de metadatos:
+#   vocab.bin / vocab_offsets.npy     -> tokens ordenados alfabéticamente
+#   postings.npy / posting_offsets.npy -> uint32 concatenados; los del token t son postings[off[t]:off[t+1]]
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+class InvertedIndexBuilder:
+    def __init__(self):
+        self._postings = {} # token -> array('I') de IDs (crecientes, sin repetidos)
+
+    def add(self, caption_id, text):
+        for token in set(tokenize(text)):
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = array('I')
+            postings.append(caption_id)
+
+    def write(self, directory):
+        vocab = sorted(self._postings)
+        vocab_offsets = array('q', [0])
+        posting_offsets = array('q', [0])
+        with open(os.path.join(directory, "vocab.bin"), "wb") as f:
+            for token in vocab:
+                data = token.encode("utf-8")
+                f.write(data)
+                vocab_offsets.append(vocab_offsets[-1] + len(data))
+                posting_offsets.append(posting_offsets[-1] + len(self._postings[token]))
+        postings = np.empty(posting_offsets[-1], dtype=np.uint32)
+        for i, token in enumerate(vocab):
+            postings[posting_offsets[i]:posting_offsets[i + 1]] = np.frombuffer(self._postings[token], dtype=np.uint32)
+        np.save(os.path.join(directory, "vocab_offsets.npy"), np.frombuffer(vocab_offsets, dtype=np.int64))
+        np.save(os.path.join(directory, "posting_offsets.npy"), np.frombuffer(posting_offsets, dtype=np.int64))
+        np.save(os.path.join(directory, "postings.npy"), postings)
+
+class InvertedIndex:
+    def __init__(self, directory):
+        self.postings = np.load(os.path.join(directory, "postings.npy"), mmap_mode='r')
+        self.posting_offsets = np.load(os.path.join(directory, "posting_offsets.npy"), mmap_mode='r')
+        with open(os.path.join(directory, "vocab.bin"), "rb") as f:
+            blob = f.read()
+        offsets = np.load(os.path.join(directory, "vocab_offsets.npy"))
+        # El vocabulario es pequeño (decenas de miles de tokens): se carga como dict
+        self.vocab = {blob[offsets[i]:offsets[i + 1]].decode("utf-8"): i for i in range(len(offsets) - 1)}
+
+    def lookup(self, token):
+        i = self.vocab.get(token)
+        if i is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]], dtype=np.int64)
+
+    def document_frequency(self, token):
+        i = self.vocab.get(token)
+        return 0 if i is None else int(self.posting_offsets[i + 1] - self.posting_offsets[i])
+
+# --- Expresiones de filtro ---
+#
+#   perro playa            -> descripciones con 'perro' Y 'playa' (AND implícito)
+#   perro OR gato          -> con cualquiera de los dos
+#   perro NOT playa        -> con 'perro' y sin 'playa' (también: perro -playa)
+#   (perro OR gato) agua   -> paréntesis para agrupar
+#   image:1000092795.jpg   -> descripciones de esa imagen
+#   "red car"              -> las comillas agrupan palabras (equivale a red AND car)
+
+FILTER_TOKEN_RE = re.compile(r'\(|\)|"[^"]*"|-?[^\s()"]+')
+
+class FilterSyntaxError(ValueError):
+    pass
+
+def parse_filter(expression):
+    # Devuelve un árbol de tuplas: ('term', t), ('image', id), ('and', a, b), ('or', a, b), ('not', a)
+    tokens = FILTER_TOKEN_RE.findall(expression)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def parse_or():
+        nonlocal pos
+        node = parse_and()
+        while peek() is not None and peek().upper() == "OR":
+            pos += 1
+            node = ("or", node, parse_and())
+        return node
+
+    def parse_and():
+        nonlocal pos
+        node = parse_unary()
+        while peek() is not None and peek() != ")" and peek().upper() != "OR":
+            if peek().upper() == "AND":
+                pos += 1
+            node = ("and", node, parse_unary())
+        return node
+
+    def parse_unary():
+        nonlocal pos
+        token = peek()
+        if token is None:
+            raise FilterSyntaxError(f"Filtro incompleto: '{expression}'")
+        pos += 1
+        if token.upper() == "NOT":
+            return ("not", parse_unary())
+        if token == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise FilterSyntaxError(f"Falta ')' en el filtro: '{expression}'")
+            pos += 1
+            return node
+        if token == ")":
+            raise FilterSyntaxError(f"')' inesperado en el filtro: '{expression}'")
+        if token.startswith("-") and len(token) > 1:
+            return ("not", term_node(token[1:]))
+        return term_node(token)
+
+    def term_node(token):
+        if token.lower().startswith("image:"):
+            return ("image", token[len("image:"):])
+        words = tokenize(token.strip('"'))
+        if not words:
+            raise FilterSyntaxError(f"Término vacío en el filtro: '{expression}'")
+        node = ("term", words[0])
+        for word in words[1:]:
+            node = ("and", node, ("term", word))
+        return node
+
+    node = parse_or()
+    if pos != len(tokens):
+        raise FilterSyntaxError(f"No se pudo interpretar el filtro: '{expression}'")
+    return node
+
+def evaluate_filter(node, inverted_index, num_captions, image_captions):
+    # Evalúa el árbol sobre las listas de IDs; devuelve un array ordenado de IDs de descripción.
+    # `image_captions(image_id)` devuelve los IDs de las descripciones de una imagen.
+    kind = node[0]
+    if kind == "term":
+        return inverted_index.lookup(node[1])
+    if kind == "image":
+        return image_captions(node[1])
+    if kind == "and":
+        left = evaluate_filter(node[1], inverted_index, num_captions, image_captions)
+        if len(left) == 0:
+            return left
+        return np.intersect1d(left, evaluate_filter(node[2], inverted_index, num_captions, image_captions), assume_unique=True)
+    if kind == "or":
+        return np.union1d(evaluate_filter(node[1], inverted_index, num_captions, image_captions),
+                          evaluate_filter(node[2], inverted_index, num_captions, image_captions))
+    if kind == "not":
+        return np.setdiff1d(np.arange(num_captions, dtype=np.int64),
+                            evaluate_filter(node[1], inverted_index, num_captions, image_captions), assume_unique=True)
+    raise FilterSyntaxError(f"Nodo de filtro desconocido: {kind}")
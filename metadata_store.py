@@ -0,0 +1,250 @@
+# metadata_store.py
+import os
+import json
+import shutil
+import time
+from array import array
+import numpy as np
+from inverted_index import InvertedIndexBuilder, InvertedIndex, parse_filter, evaluate_filter
+
+# Almacén columnar de metadatos, pensado para abrirse con mmap (sin unpickle ni un dict por fila).
+#
+# Formato del directorio:
+#   meta.json            -> carpeta de imágenes, número de filas, formato, versión, miniaturas
+#   captions.bin         -> todas las descripciones en UTF-8, concatenadas
+#   caption_offsets.npy  -> int64 (n+1): la descripción i es captions.bin[off[i]:off[i+1]]
+#   caption_image.npy    -> int32 (n): índice de imagen de cada descripción
+#   image_ids.bin / image_id_offsets.npy       -> IDs de imagen internados (uno por imagen)
+#   image_files.bin / image_file_offsets.npy   -> nombre de archivo relativo a la carpeta de imágenes
+#   image_caption_order.npy / image_caption_offsets.npy -> descripciones de cada imagen: las de la
+#       imagen j son image_caption_order[off[j]:off[j+1]] (para índices a nivel de imagen)
+#   vocab.bin, postings.npy, ...      -> índice invertido de las descripciones (ver inverted_index.py)
+FORMAT_VERSION = 1
+
+class MetadataStoreWriter:
+    # Escribe el almacén de forma incremental en un directorio temporal y lo publica en `close()`.
+    def __init__(self, path, image_folder, version=None, extra=None):
+        self.path = path
+        # Información adicional para meta.json (p. ej. configuración de miniaturas)
+        self.extra = extra or {}
+        # Versión del índice: cambia en cada construcción o 'append', y permite a los
+        # procesos que sirven consultas detectar que deben recargar e invalidar cachés.
+        self.version = version or str(time.time_ns())
+        self.tmp_path = path + ".tmp"
+        self.image_folder = image_folder
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self._captions = open(os.path.join(self.tmp_path, "captions.bin"), "wb")
+        self._caption_offsets = array('q', [0])
+        self._caption_image = array('i')
+        self._images = {} # image_id -> índice de imagen
+        self._image_ids = []
+        self._image_files = []
+        self._inverted = InvertedIndexBuilder()
+
+    def add(self, image_path, image_id, description):
+        image_idx = self._images.get(image_id)
+        if image_idx is None:
+            image_idx = len(self._image_ids)
+            self._images[image_id] = image_idx
+            self._image_ids.append(image_id)
+            # Solo se guarda la ruta relativa: la carpeta de imágenes no se repite por fila
+            self._image_files.append(os.path.relpath(image_path, self.image_folder))
+        self._inverted.add(len(self._caption_image), description)
+        data = description.encode("utf-8")
+        self._captions.write(data)
+        self._caption_offsets.append(self._caption_offsets[-1] + len(data))
+        self._caption_image.append(image_idx)
+
+    def extend(self, records):
+        for item in records:
+            self.add(item["image_path"], item["image_id"], item["description"])
+
+    def __len__(self):
+        return len(self._caption_image)
+
+    def _write_strings(self, name, strings):
+        offsets = array('q', [0])
+        with open(os.path.join(self.tmp_path, f"{name}s.bin"), "wb") as f:
+            for s in strings:
+                data = s.encode("utf-8")
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        np.save(os.path.join(self.tmp_path, f"{name}_offsets.npy"), np.frombuffer(offsets, dtype=np.int64))
+
+    def finish(self):
+        # Termina de escribir el directorio temporal (sin publicarlo todavía)
+        self._captions.close()
+        np.save(os.path.join(self.tmp_path, "caption_offsets.npy"), np.frombuffer(self._caption_offsets, dtype=np.int64))
+        np.save(os.path.join(self.tmp_path, "caption_image.npy"), np.frombuffer(self._caption_image, dtype=np.int32))
+        caption_image = np.frombuffer(self._caption_image, dtype=np.int32)
+        np.save(os.path.join(self.tmp_path, "image_caption_order.npy"), np.argsort(caption_image, kind="stable").astype(np.int64))
+        counts = np.bincount(caption_image, minlength=len(self._image_ids))
+        np.save(os.path.join(self.tmp_path, "image_caption_offsets.npy"), np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        self._inverted.write(self.tmp_path)
+        self._write_strings("image_id", self._image_ids)
+        self._write_strings("image_file", self._image_files)
+        with open(os.path.join(self.tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "format": FORMAT_VERSION,
+                "image_folder": self.image_folder,
+                "num_captions": len(self._caption_image),
+                "num_images": len(self._image_ids),
+                "version": self.version,
+                **self.extra,
+            }, f, indent=2)
+
+    def publish(self):
+        # Publica el nuevo directorio reemplazando al anterior
+        old_path = self.path + ".old"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.exists(self.path):
+            os.rename(self.path, old_path)
+        os.rename(self.tmp_path, self.path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+    def close(self):
+        self.finish()
+        self.publish()
+
+    def abort(self):
+        # Descarta el directorio temporal sin publicar nada
+        if not self._captions.closed:
+            self._captions.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+def _mmap_bytes(path):
+    # np.memmap no admite archivos vacíos
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+class _StringTable:
+    def __init__(self, blob_path, offsets_path):
+        self.blob = _mmap_bytes(blob_path)
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+class MetadataStore:
+    # Lectura del almacén: todo está mapeado en memoria (compartido entre procesos por el
+    # caché de páginas del SO) y solo se decodifican las filas que se piden.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.info = json.load(f)
+        if self.info.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Formato de metadatos no soportado en '{path}': {self.info.get('format')}")
+        self.image_folder = self.info["image_folder"]
+        self.captions = _StringTable(os.path.join(path, "captions.bin"), os.path.join(path, "caption_offsets.npy"))
+        self.caption_image = np.load(os.path.join(path, "caption_image.npy"), mmap_mode='r')
+        self.image_ids = _StringTable(os.path.join(path, "image_ids.bin"), os.path.join(path, "image_id_offsets.npy"))
+        self.image_files = _StringTable(os.path.join(path, "image_files.bin"), os.path.join(path, "image_file_offsets.npy"))
+
+        self.image_caption_order = np.load(os.path.join(path, "image_caption_order.npy"), mmap_mode='r')
+        self.image_caption_offsets = np.load(os.path.join(path, "image_caption_offsets.npy"), mmap_mode='r')
+        # 'caption': cada fila del índice FAISS es una descripción; 'image': cada fila es una imagen
+        self.level = self.info.get("level", "caption")
+        self._inverted_index = None
+        self._image_lookup = None
+
+    def __len__(self):
+        # Número de filas del índice FAISS al que acompañan estos metadatos
+        return self.num_images if self.level == "image" else len(self.caption_image)
+
+    @property
+    def num_images(self):
+        return len(self.image_ids)
+
+    def image_of(self, row):
+        # Índice de imagen de una fila del índice FAISS
+        return int(row) if self.level == "image" else int(self.caption_image[row])
+
+    def get_caption(self, caption_id):
+        image_idx = int(self.caption_image[caption_id])
+        return {
+            "image_path": os.path.join(self.image_folder, self.image_files[image_idx]),
+            "image_id": self.image_ids[image_idx],
+            "description": self.captions[caption_id],
+        }
+
+    def get_image(self, image_idx):
+        # Registro de una imagen con todas sus descripciones como contenido
+        caption_ids = self.image_caption_order[self.image_caption_offsets[image_idx]:self.image_caption_offsets[image_idx + 1]]
+        captions = [self.captions[int(c)] for c in caption_ids]
+        return {
+            "image_path": os.path.join(self.image_folder, self.image_files[image_idx]),
+            "image_id": self.image_ids[image_idx],
+            "description": captions[0] if captions else "",
+            "captions": captions,
+        }
+
+    @property
+    def inverted_index(self):
+        # Se carga al usar el primer filtro
+        if self._inverted_index is None:
+            if not os.path.exists(os.path.join(self.path, "vocab.bin")):
+                raise ValueError("Estos metadatos no tienen índice invertido. Reconstruye el índice con indexer.py.")
+            self._inverted_index = InvertedIndex(self.path)
+        return self._inverted_index
+
+    def image_index(self, image_id):
+        if self._image_lookup is None:
+            self._image_lookup = {self.image_ids[i]: i for i in range(self.num_images)}
+        return self._image_lookup.get(image_id)
+
+    def image_caption_ids(self, image_id):
+        image_idx = self.image_index(image_id)
+        if image_idx is None:
+            return np.zeros(0, dtype=np.int64)
+        ids = self.image_caption_order[self.image_caption_offsets[image_idx]:self.image_caption_offsets[image_idx + 1]]
+        return np.sort(np.asarray(ids, dtype=np.int64))
+
+    def rows_matching(self, expression):
+        # Filas del índice FAISS que cumplen la expresión de filtro (ver inverted_index.parse_filter)
+        caption_ids = evaluate_filter(parse_filter(expression), self.inverted_index, len(self.caption_image),
+                                      self.image_caption_ids)
+        if self.level == "image":
+            return np.unique(np.asarray(self.caption_image)[caption_ids]).astype(np.int64)
+        return caption_ids
+
+    def __getitem__(self, row):
+        row = int(row)
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return self.get_image(row) if self.level == "image" else self.get_caption(row)
+
+    def __iter__(self):
+        # Recorre siempre las descripciones (sirve para reescribir el almacén en modo 'append')
+        for caption_id in range(len(self.caption_image)):
+            yield self.get_caption(caption_id)
+
+def read_version(path, index_path=None):
+    # Versión publicada en disco, sin abrir el almacén completo. Para el formato antiguo
+    # se usa la fecha de modificación del índice.
+    meta_path = os.path.join(path, "meta.json")
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("version")
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        target = index_path or path
+        return str(os.path.getmtime(target)) if os.path.exists(target) else None
+
+def load_metadata(path):
+    # Abre el almacén columnar; los archivos 'metadata.npy' antiguos (lista de dicts pickleada)
+    # se siguen leyendo para no obligar a reindexar.
+    if os.path.isdir(path):
+        return MetadataStore(path)
+    if path.endswith(".npy") and os.path.exists(path):
+        print(f"Aviso: '{path}' usa el formato antiguo (pickle). Reconstruye el índice para usar el almacén con mmap.")
+        return np.load(path, allow_pickle=True)
+    raise FileNotFoundError(path)
@@ -0,0 +1,163 @@
+# metrics.py
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Métricas del proceso en memoria (contadores, valores instantáneos e histogramas de latencia),
+# exportables en el formato de texto de Prometheus. Cada worker de gunicorn tiene las suyas.
+#
+#   with metrics.span("encode_text"):   -> histograma rag_stage_duration_seconds{stage="encode_text"}
+#       ...                                y, dentro de una petición, una entrada de Server-Timing
+#   metrics.inc("rag_errors_total", component="generate")
+
+# Límites de los buckets de latencia (segundos)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "rag_stage_duration_seconds": "Duración de cada etapa del camino de búsqueda",
+    "rag_request_duration_seconds": "Duración de las peticiones HTTP",
+    "rag_requests_total": "Peticiones HTTP atendidas",
+    "rag_errors_total": "Errores manejados, por componente",
+}
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {} # nombre -> (tipo, {etiquetas: valor})
+        self._histograms = {} # nombre -> {etiquetas: [conteos por bucket, suma, total]}
+        self._local = threading.local() # Tiempos de la petición en curso (para Server-Timing)
+
+    def inc(self, name, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values.setdefault(name, ("counter", {}))[1]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, kind="gauge", **labels):
+        # Valor instantáneo; con kind='counter' se publican contadores que se llevan en otro sitio
+        # (p. ej. aciertos de LRUCache), copiándolos en el momento de exportar
+        with self._lock:
+            self._values.setdefault(name, (kind, {}))[1][_label_key(labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[0][i] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    @contextmanager
+    def span(self, stage):
+        # Mide una etapa (los errores se cuentan donde se manejan, con rag_errors_total)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("rag_stage_duration_seconds", elapsed, stage=stage)
+            timings = getattr(self._local, "timings", None)
+            if timings is not None:
+                timings.append((stage, elapsed))
+
+    # --- Tiempos por petición (solo las etapas que se ejecutan en el hilo de la petición) ---
+
+    def begin_request(self):
+        self._local.timings = []
+
+    def end_request(self):
+        timings = getattr(self._local, "timings", None) or []
+        self._local.timings = None
+        return timings
+
+    @staticmethod
+    def server_timing(timings):
+        # Cabecera Server-Timing (visible en las herramientas de desarrollo del navegador)
+        totals = {}
+        for stage, elapsed in timings:
+            totals[stage] = totals.get(stage, 0.0) + elapsed
+        return ", ".join(f"{re.sub(r'[^A-Za-z0-9_-]', '_', stage)};dur={elapsed * 1000:.1f}" for stage, elapsed in totals.items())
+
+    def render(self):
+        # Formato de texto de Prometheus (versión 0.0.4)
+        lines = []
+        with self._lock:
+            for name in sorted(self._values):
+                kind, series = self._values[name]
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name in sorted(self._histograms):
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, (counts, total, count) in sorted(self._histograms[name].items()):
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', repr(bound))])} {bucket_count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+class RequestProfiler:
+    # Perfilador para peticiones concretas. Usa pyinstrument (muestreo, poca sobrecarga) si está
+    # instalado (pip install pyinstrument); si no, cProfile de la biblioteca estándar.
+    def __init__(self, interval=0.001):
+        try:
+            from pyinstrument import Profiler
+            self.kind = "pyinstrument"
+            self._profiler = Profiler(interval=interval)
+        except ImportError:
+            import cProfile
+            self.kind = "cprofile"
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        if self.kind == "pyinstrument":
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self):
+        if self.kind == "pyinstrument":
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+
+    def save(self, directory, name):
+        # HTML interactivo con pyinstrument; archivo .prof (snakeviz, pstats) con cProfile
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+        if self.kind == "pyinstrument":
+            path = os.path.join(directory, name + ".html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self._profiler.output_html())
+        else:
+            path = os.path.join(directory, name + ".prof")
+            self._profiler.dump_stats(path)
+        return path
+
+# Métricas compartidas por todos los módulos del proceso
+metrics = Metrics()
@@ -1,72 +1,359 @@
 # retriever.py
+import hashlib
+import threading
+import time
 import faiss
 import numpy as np
+from PIL import Image
 from encoder import MultimodalEncoder # Importar la clase MultimodalEncoder
+from index_factory import search_params, search_subset # Parámetros por consulta y búsqueda restringida a un subconjunto
+from metadata_store import load_metadata, read_version # Metadatos columnares mapeados en memoria
+from cache import LRUCache # Cachés LRU con TTL para embeddings y resultados
+from metrics import metrics # Tiempos por etapa (encode, búsqueda, metadatos)
 import os
 
 class Retriever:
-    def __init__(self, index_path="faiss_index.bin", metadata_path="metadata.npy"):
-        self.encoder = MultimodalEncoder() # Inicializa el encoder para codificar las consultas
+    def __init__(self, index_path="faiss_index.bin", metadata_path="metadata_store", nprobe=None, ef_search=None,
+                 embedding_cache_size=1024, result_cache_size=4096, cache_ttl=3600, reload_check_interval=5.0,
+                 distinct_images=True, overfetch=4, encoder=None, mmap_index=True,
+                 filter_cache_size=256, filter_cache_mb=64, filter_brute_force=2048):
+        # Inicializa el encoder para codificar las consultas (se puede pasar uno ya creado,
+        # p. ej. con otro backend de inferencia o solo con la torre de texto)
+        self.encoder = encoder or MultimodalEncoder()
+        self.index_path = index_path
+        self.metadata_path = metadata_path
+        # Valores por defecto de los parámetros de búsqueda aproximada (se pueden
+        # sobrescribir en cada consulta): nprobe para índices IVF, efSearch para HNSW.
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # Con un índice por descripción, una misma imagen puede aparecer varias veces en el top-k.
+        # Con distinct_images=True se piden `overfetch`*k vecinos (más si hace falta) y se devuelven
+        # k imágenes distintas. Un índice a nivel de imagen ya devuelve imágenes distintas.
+        self.distinct_images = distinct_images
+        self.overfetch = overfetch
+        # Cachés: texto/hash de imagen -> embedding, y (embedding, k, versión, params) -> IDs de resultado
+        self.embedding_cache = LRUCache(maxsize=embedding_cache_size, ttl=cache_ttl)
+        self.result_cache = LRUCache(maxsize=result_cache_size, ttl=cache_ttl)
+        # Filtros por palabras clave: (versión, expresión) -> filas del índice que la cumplen.
+        # Limitada también en bytes: un filtro muy general (o un NOT) sobre un corpus grande da
+        # un array de varios MB. Con filtros que dejan pocas filas (<= filter_brute_force) se
+        # calculan las distancias exactas sobre esas filas en lugar de usar un selector.
+        self.filter_cache = LRUCache(maxsize=filter_cache_size, ttl=cache_ttl, max_bytes=filter_cache_mb * 2**20)
+        self.filter_brute_force = filter_brute_force
+        # Cada cuántos segundos se comprueba si se publicó una nueva versión del índice
+        self.reload_check_interval = reload_check_interval
+        self.mmap_index = mmap_index
+        self._last_version_check = time.monotonic()
+        self._reload_lock = threading.Lock()
+        # (índice, metadatos, versión): se sustituye de una vez al recargar
+        self._snapshot = (None, None, None)
+        self._load()
+
+    @property
+    def index(self):
+        return self._snapshot[0]
+
+    @property
+    def metadata(self):
+        return self._snapshot[1]
+
+    @property
+    def index_version(self):
+        return self._snapshot[2]
+
+    def _open(self):
+        # Abre metadatos e índice de una misma versión publicada. Los metadatos indican qué
+        # archivo de índice les corresponde (ver indexer.save_index).
+        # Los metadatos se mapean en memoria: solo se decodifican las k filas de cada búsqueda
+        metadata = load_metadata(self.metadata_path)
+        info = getattr(metadata, "info", {})
+        version = info.get("version") or read_version(self.metadata_path, self.index_path)
+        index_path = self.index_path
+        if info.get("index_file"):
+            index_path = os.path.join(os.path.dirname(os.path.abspath(self.index_path)), info["index_file"])
+        index = None
+        if self.mmap_index:
+            # Con mmap, los vectores no se copian a la memoria privada del proceso: varios workers
+            # comparten las mismas páginas del caché del SO. IO_FLAG_MMAP solo mapea las listas
+            # invertidas de los índices IVF; los códigos de 'flat', 'sq8', 'sq_fp16' y 'hnsw'
+            # necesitan IO_FLAG_MMAP_IFC (faiss >= 1.10). Sin él, esos índices se cargan enteros
+            # en cada worker (y en cada recarga).
+            mmap_ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | mmap_ifc | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                index = None
+            if index is None:
+                print(f"Aviso: el índice '{index_path}' no admite mmap; se carga en la memoria privada del proceso.")
+            elif not mmap_ifc and not isinstance(index, faiss.IndexIVF):
+                print(f"Aviso: esta versión de faiss no tiene IO_FLAG_MMAP_IFC; el índice {type(index).__name__} "
+                      "se carga en la memoria privada de cada proceso (solo los índices IVF se comparten con mmap).")
+        if index is None:
+            index = faiss.read_index(index_path)
+        return (index, metadata, version)
+
+    def _load(self):
         try:
-            self.index = faiss.read_index(index_path)
-            self.metadata = np.load(metadata_path, allow_pickle=True)
-            print(f"Índice FAISS cargado con {self.index.ntotal} elementos y {len(self.metadata)} entradas de metadatos.")
-        except FileNotFoundError:
-            print(f"Error: Archivos de índice/metadatos no encontrados en '{index_path}' o '{metadata_path}'.")
+            self._snapshot = self._open()
+            index, metadata, version = self._snapshot
+            print(f"Índice FAISS cargado con {index.ntotal} elementos y {len(metadata)} entradas de metadatos (versión {version}).")
+        except (FileNotFoundError, RuntimeError):
+            # faiss.read_index lanza RuntimeError si el archivo no existe
+            print(f"Error: Archivos de índice/metadatos no encontrados en '{self.index_path}' o '{self.metadata_path}'.")
             print("Por favor, asegúrate de haber ejecutado 'indexer.py' primero para crearlos.")
-            self.index = None
-            self.metadata = None
+            self._snapshot = (None, None, None)
+
+    def warm_up(self):
+        # Ejecuta una consulta de prueba para que la primera petición real no pague la
+        # inicialización perezosa (hilos de inferencia, asignación de buffers, páginas del índice)
+        start = time.perf_counter()
+        if self.index is not None:
+            if self.encoder.has_text:
+                self._search(self.index, self.encoder.encode_text("warm up"), 1)
+            if self.encoder.has_vision:
+                self._search(self.index, self.encoder.encode_image(Image.new("RGB", (224, 224))), 1)
+        print(f"Calentamiento del Retriever completado en {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def refresh_if_changed(self, force=False):
+        # Recarga índice y metadatos si build_index publicó una versión nueva (reconstrucción
+        # o 'append'). Las entradas de la caché de resultados quedan invalidadas.
+        now = time.monotonic()
+        if not force and now - self._last_version_check < self.reload_check_interval:
+            return False
+        self._last_version_check = now
+        if read_version(self.metadata_path, self.index_path) == self.index_version:
+            return False
+        with self._reload_lock:
+            if read_version(self.metadata_path, self.index_path) == self.index_version:
+                return False
+            print("Nueva versión del índice detectada. Recargando...")
+            try:
+                # El cambio de versión es atómico: las búsquedas en curso terminan con la anterior
+                self._snapshot = self._open()
+            except (FileNotFoundError, RuntimeError) as e:
+                print(f"Error al recargar el índice, se mantiene la versión {self.index_version}: {e}")
+                return False
+            self.result_cache.clear()
+            return True
+
+    def cache_stats(self):
+        return {
+            "index_version": self.index_version,
+            "embedding_cache": self.embedding_cache.stats(),
+            "result_cache": self.result_cache.stats(),
+            "filter_cache": self.filter_cache.stats(),
+        }
+
+    def _embed_texts(self, queries):
+        # Embeddings de las consultas de texto, codificando por lotes solo las que no están en caché
+        embeddings = [self.embedding_cache.get(("text", q)) for q in queries]
+        missing = list(dict.fromkeys(q for q, e in zip(queries, embeddings) if e is None))
+        if missing:
+            with metrics.span("encode_text"):
+                encoded = self.encoder.encode_texts(missing, batch_size=len(missing), num_workers=1)
+            fresh = {q: e.copy() for q, e in zip(missing, encoded)}
+            for q, e in fresh.items():
+                self.embedding_cache.put(("text", q), e)
+            embeddings = [e if e is not None else fresh[q] for q, e in zip(queries, embeddings)]
+        return np.stack(embeddings).astype('float32')
+
+    def _embed_image(self, image):
+        # Las imágenes de consulta se identifican por el hash de sus bytes
+        if isinstance(image, Image.Image):
+            data = image.tobytes() + f"{image.mode}{image.size}".encode("ascii")
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            data = bytes(image)
+        elif hasattr(image, "read"):
+            data = image.read()
+            image = data
+        else:
+            with open(image, "rb") as f:
+                data = f.read()
+            image = data # Se codifica desde memoria, sin volver a leer el archivo
+        key = ("image", hashlib.sha1(data).hexdigest())
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            with metrics.span("encode_image"): # Incluye la decodificación de la imagen
+                embedding = self.encoder.encode_image(image)[0]
+            self.embedding_cache.put(key, embedding)
+        return embedding[None, :].astype('float32')
 
-    def retrieve_by_image(self, image_path, k=5):
-        if self.index is None:
+    def _filter_rows(self, snapshot, filter_expr):
+        # Filas del índice que cumplen el filtro (None si no hay filtro)
+        filter_expr = (filter_expr or "").strip()
+        if not filter_expr:
+            return None
+        _, metadata, version = snapshot
+        key = (version, filter_expr)
+        rows = self.filter_cache.get(key)
+        if rows is None:
+            if not hasattr(metadata, "rows_matching"):
+                raise ValueError("Los metadatos en formato antiguo no admiten filtros. Reconstruye el índice.")
+            with metrics.span("filter"):
+                rows = metadata.rows_matching(filter_expr)
+            self.filter_cache.put(key, rows)
+        return rows
+
+    def _search(self, index, query_embeddings, k, nprobe=None, ef_search=None, rows=None):
+        with metrics.span("index_search"):
+            return self._search_index(index, query_embeddings, k, nprobe=nprobe, ef_search=ef_search, rows=rows)
+
+    def _search_index(self, index, query_embeddings, k, nprobe=None, ef_search=None, rows=None):
+        # Realiza la búsqueda en el índice. `astype('float32')` es importante para FAISS.
+        if rows is not None:
+            return search_subset(index, query_embeddings, k, rows, brute_force_threshold=self.filter_brute_force,
+                                 nprobe=nprobe if nprobe is not None else self.nprobe,
+                                 ef_search=ef_search if ef_search is not None else self.ef_search)
+        params = search_params(index,
+                               nprobe=nprobe if nprobe is not None else self.nprobe,
+                               ef_search=ef_search if ef_search is not None else self.ef_search)
+        query = np.ascontiguousarray(query_embeddings, dtype='float32')
+        if params is not None:
+            return index.search(query, k, params=params)
+        return index.search(query, k)
+
+    def _search_cached(self, snapshot, query_embeddings, k, nprobe=None, ef_search=None, filter_expr=None, rows=None):
+        # Devuelve una lista de (distancias, índices) por consulta. Solo las consultas sin
+        # resultado en caché se buscan en FAISS, todas juntas en una única llamada.
+        index, metadata, version = snapshot
+        if getattr(metadata, "info", {}).get("normalized"):
+            # El índice guarda vectores normalizados (nivel de imagen): se normalizan también las consultas
+            query_embeddings = query_embeddings / np.maximum(np.linalg.norm(query_embeddings, axis=1, keepdims=True), 1e-12)
+            query_embeddings = query_embeddings.astype('float32')
+        nprobe = nprobe if nprobe is not None else self.nprobe
+        ef_search = ef_search if ef_search is not None else self.ef_search
+        filter_expr = (filter_expr or "").strip() or None
+        keys = [(hashlib.sha1(e.tobytes()).hexdigest(), k, version, nprobe, ef_search, filter_expr) for e in query_embeddings]
+        hits = [self.result_cache.get(key) for key in keys]
+        missing = [i for i, hit in enumerate(hits) if hit is None]
+        if missing:
+            distances, indices = self._search(index, query_embeddings[missing], k, nprobe=nprobe, ef_search=ef_search, rows=rows)
+            for row, i in enumerate(missing):
+                hits[i] = (distances[row].copy(), indices[row].copy())
+                self.result_cache.put(keys[i], hits[i])
+        return hits
+
+    def _search_distinct(self, snapshot, query_embeddings, k, nprobe=None, ef_search=None, filter_expr=None):
+        # Como _search_cached, pero quedándose con el mejor resultado de cada imagen.
+        # Con `filter_expr` solo se buscan las filas que cumplen el filtro (ver inverted_index.parse_filter).
+        index, metadata, _ = snapshot
+        rows = self._filter_rows(snapshot, filter_expr)
+        if rows is not None and len(rows) == 0:
+            empty = (np.zeros(0, dtype='float32'), np.zeros(0, dtype=np.int64))
+            return [empty for _ in query_embeddings]
+        cached = dict(nprobe=nprobe, ef_search=ef_search, filter_expr=filter_expr, rows=rows)
+        if not self.distinct_images or getattr(metadata, "level", "caption") == "image":
+            return self._search_cached(snapshot, query_embeddings, k, **cached)
+
+        total = index.ntotal if rows is None else len(rows)
+        k_fetch = max(k, min(k * self.overfetch, total))
+        hits = self._search_cached(snapshot, query_embeddings, k_fetch, **cached)
+        distinct = []
+        for qi, (distances, indices) in enumerate(hits):
+            query_k = k_fetch
+            while True:
+                seen = set()
+                keep = []
+                for pos, idx in enumerate(indices):
+                    if idx < 0:
+                        continue
+                    image = metadata.image_of(idx) if hasattr(metadata, "image_of") else metadata[idx]["image_id"]
+                    if image not in seen:
+                        seen.add(image)
+                        keep.append(pos)
+                        if len(keep) == k:
+                            break
+                if len(keep) >= k or query_k >= total:
+                    break
+                # No hay suficientes imágenes distintas: se duplica el número de vecinos pedidos
+                query_k = min(query_k * 2, total)
+                distances, indices = self._search_cached(snapshot, query_embeddings[qi:qi + 1], query_k, **cached)[0]
+            distinct.append((distances[keep], indices[keep]))
+        return distinct
+
+    def _format_results(self, metadata, distances, indices):
+        with metrics.span("metadata"):
+            return self._lookup_results(metadata, distances, indices)
+
+    def _lookup_results(self, metadata, distances, indices):
+        results = []
+        # En un índice de producto escalar (nivel de imagen con vectores 'fused') FAISS devuelve
+        # similitudes, de mayor a menor: se devuelven como "similarity", y "distance" = 1 - similitud
+        similarity = getattr(metadata, "info", {}).get("metric") == "inner_product"
+        # Iterar sobre los índices de los resultados (FAISS devuelve -1 si hay menos de k resultados)
+        for i, idx in enumerate(indices):
+            if 0 <= idx < len(metadata): # Asegurarse de que el índice es válido
+                item = metadata[idx]
+                results.append({
+                    "id": int(idx), # Fila del índice (ID de la descripción)
+                    "image_path": item["image_path"],
+                    "image_id": item["image_id"],
+                    "description": item["description"],
+                    "distance": 1 - distances[i] if similarity else distances[i] # La distancia calculada por FAISS
+                })
+                if similarity:
+                    results[-1]["similarity"] = distances[i]
+                if "captions" in item: # Índice a nivel de imagen: todas sus descripciones
+                    results[-1]["captions"] = item["captions"]
+            elif idx >= 0:
+                print(f"Advertencia: Índice {idx} fuera de los límites de los metadatos. Skipeando.")
+        return results
+
+    def retrieve_by_image(self, image, k=5, nprobe=None, ef_search=None, filter_expr=None):
+        # `image` puede ser una ruta, bytes (p. ej. un archivo subido), un objeto tipo archivo o una imagen PIL.
+        # `filter_expr` restringe la búsqueda a las descripciones que cumplen el filtro, p. ej. 'dog -cat'.
+        self.refresh_if_changed()
+        snapshot = self._snapshot
+        if snapshot[0] is None:
             return []
         try:
-            query_embedding = self.encoder.encode_image(image_path)
-            # Realiza la búsqueda en el índice. `astype('float32')` es importante para FAISS.
-            distances, indices = self.index.search(query_embedding.astype('float32'), k)
-            results = []
-            # Iterar sobre los índices de los resultados
-            for i, idx in enumerate(indices[0]):
-                if idx < len(self.metadata): # Asegurarse de que el índice es válido
-                    item = self.metadata[idx]
-                    results.append({
-                        "image_path": item["image_path"],
-                        "description": item["description"],
-                        "distance": distances[0][i] # La distancia calculada por FAISS
-                    })
-                else:
-                    print(f"Advertencia: Índice {idx} fuera de los límites de los metadatos. Skipeando.")
-            return results
+            query_embedding = self._embed_image(image)
+            distances, indices = self._search_distinct(snapshot, query_embedding, k, nprobe=nprobe, ef_search=ef_search,
+                                                       filter_expr=filter_expr)[0]
+            return self._format_results(snapshot[1], distances, indices)
         except FileNotFoundError:
-            print(f"Error: La imagen de consulta no se encontró en {image_path}.")
+            print(f"Error: La imagen de consulta no se encontró en {image}.")
+            metrics.inc("rag_errors_total", component="retrieve_image")
             return []
         except Exception as e:
             print(f"Error al recuperar por imagen: {e}")
+            metrics.inc("rag_errors_total", component="retrieve_image")
             return []
 
 
-    def retrieve_by_text(self, query_text, k=5):
-        if self.index is None:
+    def retrieve_by_text(self, query_text, k=5, nprobe=None, ef_search=None, filter_expr=None):
+        self.refresh_if_changed()
+        snapshot = self._snapshot
+        if snapshot[0] is None:
             return []
         try:
-            query_embedding = self.encoder.encode_text(query_text)
-            # Realiza la búsqueda en el índice
-            distances, indices = self.index.search(query_embedding.astype('float32'), k)
-            results = []
-            for i, idx in enumerate(indices[0]):
-                if idx < len(self.metadata):
-                    item = self.metadata[idx]
-                    results.append({
-                        "image_path": item["image_path"],
-                        "description": item["description"],
-                        "distance": distances[0][i]
-                    })
-                else:
-                    print(f"Advertencia: Índice {idx} fuera de los límites de los metadatos. Skipeando.")
-            return results
+            query_embedding = self._embed_texts([query_text])
+            distances, indices = self._search_distinct(snapshot, query_embedding, k, nprobe=nprobe, ef_search=ef_search,
+                                                       filter_expr=filter_expr)[0]
+            return self._format_results(snapshot[1], distances, indices)
         except Exception as e:
             print(f"Error al recuperar por texto: {e}")
+            metrics.inc("rag_errors_total", component="retrieve_text")
+            return []
+
+    def retrieve_batch(self, queries, k=5, nprobe=None, ef_search=None, filter_expr=None):
+        # Recupera varias consultas de texto a la vez: una sola pasada de CLIP por lotes
+        # y una sola llamada a index.search. Devuelve una lista de resultados por consulta.
+        self.refresh_if_changed()
+        snapshot = self._snapshot
+        if snapshot[0] is None:
+            return [[] for _ in queries]
+        if not queries:
             return []
+        try:
+            query_embeddings = self._embed_texts(list(queries))
+            hits = self._search_distinct(snapshot, query_embeddings, k, nprobe=nprobe, ef_search=ef_search,
+                                         filter_expr=filter_expr)
+            return [self._format_results(snapshot[1], distances, indices) for distances, indices in hits]
+        except Exception as e:
+            print(f"Error al recuperar por lotes: {e}")
+            metrics.inc("rag_errors_total", component="retrieve_batch")
+            return [[] for _ in queries]
 
 if __name__ == '__main__':
     # Pequeña prueba para verificar el retriever
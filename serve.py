@@ -0,0 +1,78 @@
+# serve.py
+# Punto de entrada de producción: varios procesos worker (gunicorn) que comparten memoria.
+#   - Los modelos y el índice se cargan una vez en el proceso maestro, antes del fork: los workers
+#     heredan esas páginas con copy-on-write en lugar de cargar cada uno su copia de CLIP.
+#   - Los metadatos son columnas mapeadas en memoria y el índice FAISS se abre con mmap, así que
+#     el caché de páginas del SO los comparte entre todos los workers. Para el índice esto vale
+#     para los tipos IVF con cualquier versión de faiss, y para 'flat', 'sq8', 'sq_fp16' y 'hnsw'
+#     solo con faiss >= 1.10 (IO_FLAG_MMAP_IFC); si no, cada worker tiene su copia tras recargar.
+#   - Cada worker hace una consulta de calentamiento antes de aceptar peticiones.
+#   - Cada worker recarga por su cuenta (de forma atómica) cuando indexer.py publica una nueva
+#     versión del índice (ver Retriever.refresh_if_changed).
+#
+# Uso: python serve.py  (configurable con SERVE_BIND, SERVE_WORKERS, SERVE_THREADS, ENCODER_THREADS)
+import gc
+import os
+
+# Los tokenizadores de HF usan su propio pool de hilos, que no sobrevive a un fork
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+from gunicorn.app.base import BaseApplication
+
+def process_memory(pid="self"):
+    # RSS (memoria residente total) y PSS (memoria compartida repartida entre procesos), en MB
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                parts = line.split()
+                if parts[0] in ("Rss:", "Pss:", "Shared_Clean:", "Shared_Dirty:", "Private_Clean:", "Private_Dirty:"):
+                    values[parts[0][:-1].lower()] = int(parts[1]) / 1024
+    except (FileNotFoundError, PermissionError):
+        pass
+    return values
+
+class PreforkApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Con preload_app=True esto se ejecuta en el maestro, antes de crear los workers
+        import app as web
+        # Los objetos creados hasta aquí no los recorrerá el recolector de basura, así los
+        # workers no tocan (ni copian) esas páginas al hacer GC
+        gc.freeze()
+        return web.app
+
+def post_worker_init(worker):
+    import torch
+    import app as web
+    threads = int(os.getenv("ENCODER_THREADS", "0"))
+    if threads:
+        torch.set_num_threads(threads)
+    if web.retriever:
+        web.retriever.warm_up()
+    memory = process_memory()
+    if memory:
+        print(f"Worker {worker.pid} listo: RSS {memory.get('rss', 0):.0f} MB, PSS {memory.get('pss', 0):.0f} MB")
+
+if __name__ == '__main__':
+    workers = int(os.getenv("SERVE_WORKERS", "4"))
+    options = {
+        "bind": os.getenv("SERVE_BIND", "0.0.0.0:8000"),
+        "workers": workers,
+        # Varios hilos por worker: las consultas concurrentes se agrupan en QueryBatcher
+        "worker_class": "gthread",
+        "threads": int(os.getenv("SERVE_THREADS", "8")),
+        "preload_app": True,
+        "post_worker_init": post_worker_init,
+        "timeout": 60,
+    }
+    # Reparte los núcleos entre los workers si no se indicó otra cosa
+    os.environ.setdefault("ENCODER_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+    PreforkApplication(options).run()
@@ -0,0 +1,51 @@
+# thumbnails.py
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+DEFAULT_WIDTH = 256
+DEFAULT_FORMAT = "webp"
+
+def thumbnail_name(image_id, fmt=DEFAULT_FORMAT):
+    # Nombre del archivo de miniatura para un ID de imagen (p. ej. '1000092795.jpg' -> '1000092795-<hash>.webp').
+    # El hash del ID completo distingue IDs con el mismo nombre base ('a/1.jpg' y 'b/1.jpg', '1.jpg' y '1.png').
+    base = os.path.splitext(os.path.basename(image_id))[0]
+    digest = hashlib.sha1(image_id.encode("utf-8")).hexdigest()[:10]
+    return f"{base}-{digest}.{fmt}"
+
+def make_thumbnail(src_path, dst_path, width=DEFAULT_WIDTH, fmt=DEFAULT_FORMAT, quality=80):
+    with Image.open(src_path) as img:
+        # Para JPEG, decodifica directamente a una resolución reducida (mucho más rápido)
+        img.draft("RGB", (width, width))
+        img = img.convert("RGB")
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        tmp_path = dst_path + ".tmp"
+        img.save(tmp_path, format="JPEG" if fmt.lower() in ("jpg", "jpeg") else fmt.upper(), quality=quality)
+    os.replace(tmp_path, dst_path)
+
+def generate_thumbnails(images, thumbnail_dir, width=DEFAULT_WIDTH, fmt=DEFAULT_FORMAT, quality=80, num_workers=4):
+    # `images` es un iterable de pares (image_id, image_path). Solo se generan las miniaturas
+    # que faltan o que son más antiguas que la imagen original.
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    pending = []
+    for image_id, image_path in dict(images).items():
+        dst_path = os.path.join(thumbnail_dir, thumbnail_name(image_id, fmt))
+        if os.path.exists(dst_path) and os.path.getmtime(dst_path) >= os.path.getmtime(image_path):
+            continue
+        pending.append((image_path, dst_path))
+    if not pending:
+        return 0
+
+    print(f"Generando {len(pending)} miniaturas ({width}px, {fmt}) en {thumbnail_dir}...")
+    def _make(args):
+        try:
+            make_thumbnail(args[0], args[1], width=width, fmt=fmt, quality=quality)
+            return True
+        except Exception as e:
+            print(f"Error al generar la miniatura de {args[0]}: {e}")
+            return False
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        created = sum(pool.map(_make, pending))
+    return created